@@ -1,13 +1,18 @@
 import streamlit as st
 import json
 from datetime import datetime
-from modules import config, database, auth, admin, ai_engine, doc_renderer, dashboard, utils
+from modules import config, database, auth, admin, ai_engine, doc_renderer, dashboard, utils, chat_memory, retrieval, telemetry
 
 # 1. CONFIGURAZIONE PAGINA
 st.set_page_config(page_title=config.APP_NAME, layout="wide", page_icon="⚖️")
 
 # 2. INIZIALIZZAZIONE
+telemetry.begin_rerun(st.session_state)
+telemetry.avvia_endpoint_metriche()
 supabase = database.init_supabase()
+database.get_write_buffer()  # avvia il write-behind (e la ripresa del journal) all'avvio del processo
+if getattr(supabase, "is_local", False):
+    st.warning(f"⚠️ Database locale SQLite ({config.LOCAL_DB_PATH}): solo per sviluppo, i dati non sono su Supabase.")
 ai_engine.init_ai()
 
 # 3. SESSION STATE
@@ -15,11 +20,19 @@ init_vars = {
     "auth_status": "logged_out", 
     "sanitizer": ai_engine.DataSanitizer(),
     "messages": [], 
-    "contesto_chat": "", 
+    "chat_memory": chat_memory.ChatMemory(), 
     "dati_calc": "Nessun dato.",
     "workflow_step": "CHAT", 
     "current_fascicolo": None, 
-    "generated_docs_zip": None
+    "generated_docs_zip": None,
+    "doc_store": None,
+    "doc_index": None,
+    "doc_index_sig": None,
+    "doc_list": None,
+    "doc_list_fid": None,
+    "doc_contenuti": {},
+    "chat_has_more": False,
+    "chat_visibili": config.CHAT_VISIBLE_MESSAGES
 }
 for k, v in init_vars.items():
     if k not in st.session_state: st.session_state[k] = v
@@ -36,8 +49,11 @@ with st.sidebar:
     st.title(config.APP_NAME)
     st.caption(f"Ver: {config.APP_VER}")
     st.write(f"👤 {st.session_state.user_email}")
+    if config.TELEMETRY_ENABLED and (config.TELEMETRY_PANEL or st.session_state.user_role in ("admin", "user_simulated")):
+        telemetry.render_panel(st.session_state)
     
     if st.button("Esci (Logout)", key="glob_logout"):
+        if supabase: database.flush_fascicoli(supabase)
         st.session_state.auth_status = "logged_out"
         st.session_state.current_fascicolo = None
         st.rerun()
@@ -72,11 +88,16 @@ with st.sidebar:
     aggr_db = f_curr.get('livello_aggressivita', 5) or 5
     new_aggr = st.slider("Livello Aggressività", 1, 10, int(aggr_db))
     if new_aggr != aggr_db and supabase:
-        database.aggiorna_fascicolo(supabase, f_curr['id'], {"livello_aggressivita": new_aggr})
+        database.aggiorna_fascicolo_differito(supabase, f_curr['id'], {"livello_aggressivita": new_aggr})
         f_curr['livello_aggressivita'] = new_aggr
 
     st.divider()
     if st.button("⬅️ Torna alla Dashboard", type="primary"):
+        # La card in lista riflette le modifiche fatte in workstation (senza rileggere la pagina)
+        for card in st.session_state.get("dash_fascicoli") or []:
+            if card['id'] == f_curr['id']:
+                card.update({k: f_curr.get(k) for k in card})
+        if supabase: database.flush_fascicoli(supabase, f_curr['id'])
         st.session_state.current_fascicolo = None
         st.session_state.messages = []
         st.rerun()
@@ -128,16 +149,35 @@ with t1:
         """
         st.session_state.dati_calc = final_calc_str
         if supabase:
-            database.aggiorna_fascicolo(supabase, f_curr['id'], {"dati_tecnici": final_calc_str})
-            st.success("Dati aggiornati e salvati.")
+            # Salvataggio esplicito: scrittura immediata di questo fascicolo, il buffer resta la rete di sicurezza
+            database.aggiorna_fascicolo_differito(supabase, f_curr['id'], {"dati_tecnici": final_calc_str})
+            f_curr['dati_tecnici'] = final_calc_str
+            if database.flush_fascicoli(supabase, f_curr['id']):
+                st.success("Dati aggiornati e salvati.")
+            else:
+                st.warning("Dati aggiornati: salvataggio in coda, verrà ritentato a breve.")
 
 # TAB 2: CHAT STRATEGICA
 with t2:
         st.header("💬 Chat Strategica con il Fascicolo")
 
         # --- A. STORICO DOCUMENTI (Feature Archivio) ---
-        storico_docs = f_curr.get('documenti_generati')
-        if storico_docs and isinstance(storico_docs, list) and len(storico_docs) > 0:
+        # Migrazione pigra dello storico legacy (array JSON sulla riga del fascicolo)
+        if supabase and f_curr.get('documenti_generati'):
+            try:
+                database.migra_documenti_generati(supabase, f_curr['id'])
+                f_curr['documenti_generati'] = []
+                st.session_state.doc_list = None
+            except Exception as e:
+                print(f"Errore migrazione documenti: {e}")
+
+        # Solo metadati, letti una volta per fascicolo (invalidati a ogni nuova generazione)
+        if st.session_state.doc_list is None or st.session_state.doc_list_fid != f_curr['id']:
+            st.session_state.doc_list = database.lista_documenti(supabase, f_curr['id'])
+            st.session_state.doc_list_fid = f_curr['id']
+            st.session_state.doc_contenuti = {}
+        storico_docs = st.session_state.doc_list
+        if storico_docs:
             with st.expander("🗄️ Archivio Documenti Generati (Sessioni Precedenti)", expanded=False):
                 st.caption("Documenti e Trascrizioni Chat salvati.")
                 for doc in reversed(storico_docs):
@@ -145,15 +185,21 @@ with t2:
                     icon = "💬" if doc.get('tipo') == 'trascrizione_chat' else "📄"
                     
                     lbl = f"{icon} **{doc.get('titolo')}**"
-                    if 'data_creazione' in doc: lbl += f" - *{doc['data_creazione']}*"
+                    if doc.get('data_creazione'): lbl += f" - *{doc['data_creazione']}*"
                     col_d1.markdown(lbl)
                     
-                    col_d2.download_button(
-                        label="Scarica",
-                        data=doc.get('contenuto', ''),
-                        file_name=f"{doc.get('titolo')}.txt",
-                        key=f"hist_{doc.get('titolo')}_{doc.get('data_creazione', 'now')}"
-                    )
+                    # Contenuto caricato on demand, solo per il documento richiesto
+                    contenuti = st.session_state.doc_contenuti
+                    if doc['id'] in contenuti:
+                        col_d2.download_button(
+                            label="Scarica",
+                            data=contenuti[doc['id']],
+                            file_name=f"{doc.get('titolo')}.txt",
+                            key=f"hist_{doc['id']}"
+                        )
+                    elif col_d2.button("Apri", key=f"load_{doc['id']}"):
+                        contenuti[doc['id']] = database.get_contenuto_documento(supabase, doc['id'])
+                        st.rerun()
                 st.divider()
 
 # --- B. CONFIGURAZIONE AI (Solo Scelta Modello - Aggressività presa dalla Sidebar) ---
@@ -192,53 +238,110 @@ with t2:
         # --- C. UPLOAD E CHAT ---
         uploaded = st.file_uploader("Carica nuovi documenti per questa sessione", accept_multiple_files=True, key="chat_uploader")
         
-        # Estrazione testo (se caricato ora)
+        # Testi già archiviati del fascicolo: caricati una volta all'apertura, senza riparsare i PDF
+        if st.session_state.doc_index_sig is None and f_curr.get('testi_estratti'):
+            archived = database.carica_testi_fascicolo(supabase, f_curr)
+            if archived:
+                st.session_state.doc_store = archived
+                st.session_state.doc_index = retrieval.build_index_from_store(archived) if archived.size_bytes else None
+            st.session_state.doc_index_sig = ("archivio", f_curr['id'])
+
+        if st.session_state.doc_store and not uploaded:
+            n_arch = len(st.session_state.doc_store.file_names())
+            st.caption(f"🗂️ {n_arch} documenti archiviati del fascicolo già nel contesto.")
+
+        # Estrazione testo in streaming (solo quando cambia l'insieme dei file caricati)
         if uploaded:
-            file_parts, full_txt = doc_renderer.extract_text_from_files(uploaded)
-            if full_txt:
-                st.session_state.file_parts = file_parts 
-                st.success(f"Caricati {len(uploaded)} nuovi file nel contesto.")
+            upload_sig = (f_curr['id'], tuple((u.name, u.size) for u in uploaded))
+            if st.session_state.doc_index_sig != upload_sig:
+                # Barra di avanzamento creata solo se un file va davvero estratto (non in cache)
+                extract_bar = {}
+                def _on_pages(f_name, done_p, tot_p):
+                    if "bar" not in extract_bar: extract_bar["bar"] = st.progress(0)
+                    extract_bar["bar"].progress(done_p / max(tot_p, 1), f"📄 {f_name}: pagina {done_p}/{tot_p}")
+
+                # Si parte dai documenti già archiviati (esclusi quelli ricaricati ora)
+                old_store = st.session_state.doc_store
+                store = old_store.copy_excluding({u.name for u in uploaded}) if old_store else None
+                if old_store: old_store.close()
+                store = doc_renderer.extract_to_store(uploaded, progress_cb=_on_pages, store=store)
+                if "bar" in extract_bar: extract_bar["bar"].empty()
+
+                # Archivio persistente: alla riapertura del fascicolo niente re-upload
+                meta = database.salva_testi_fascicolo(supabase, f_curr['id'], store)
+                if meta: f_curr['testi_estratti'] = meta
+
+                st.session_state.doc_store = store
+                st.session_state.doc_index = retrieval.build_index_from_store(store) if store.size_bytes else None
+                st.session_state.doc_index_sig = upload_sig
+
+            store = st.session_state.doc_store
+            for err in store.errors: st.warning(err)
+            if store.size_bytes:
+                n_chunks = len(st.session_state.doc_index) if st.session_state.doc_index else 0
+                st.success(f"Caricati {len(uploaded)} nuovi file nel contesto ({n_chunks} estratti indicizzati).")
         
-        # Gestione Cronologia Visuale
+        # Gestione Cronologia Visuale (si disegnano solo gli ultimi messaggi)
         if "messages" not in st.session_state: st.session_state.messages = []
-        for m in st.session_state.messages:
+        msgs = st.session_state.messages
+        nascosti = max(len(msgs) - st.session_state.chat_visibili, 0)
+        if nascosti or st.session_state.chat_has_more:
+            if st.button("⬆️ Mostra messaggi precedenti", key="chat_older"):
+                # Pagina precedente dal DB solo quando quelle in memoria sono già tutte visibili
+                if not nascosti and msgs and msgs[0].get("id"):
+                    older, altri = database.carica_messaggi(
+                        supabase, f_curr['id'], prima_di=msgs[0]["id"], limit=config.CHAT_HISTORY_PAGE
+                    )
+                    st.session_state.messages = older + msgs
+                    st.session_state.chat_has_more = altri
+                st.session_state.chat_visibili += config.CHAT_VISIBLE_MESSAGES
+                st.rerun()
+        for m in msgs[nascosti:]:
             with st.chat_message(m["role"]): st.markdown(m["content"])
 
         # --- D. LOGICA CHAT ---
         if prompt := st.chat_input("Fai una domanda strategica..."):
             # 1. User
             st.session_state.messages.append({"role":"user", "content":prompt})
-            st.session_state.contesto_chat += f"\nUTENTE: {prompt}"
+            st.session_state.chat_memory.add("UTENTE", prompt)
             with st.chat_message("user"): st.write(prompt)
             
             # 2. AI Generation
             with st.chat_message("assistant"):
-                with st.spinner("⚖️ Analisi giuridica in corso..."):
-                    
-                    # Recupero dati calcolo se esistono
-                    dati_calc_str = st.session_state.dati_calc if "dati_calc" in st.session_state else "Nessun dato economico."
-                    
-                    resp_data = ai_engine.interroga_gemini(
-                        selected_chat_model,       # <--- USA IL MODELLO SCELTO DALL'UTENTE
-                        prompt, 
-                        st.session_state.contesto_chat,
-                        st.session_state.file_parts, 
-                        dati_calc_str, 
-                        st.session_state.sanitizer,
-                        "Listino Standard",        # Placeholder per pricing info
-                        aggression_level           # <--- USA L'AGGRESSIVITÀ DELLO SLIDER
-                    )
+                # Recupero dati calcolo se esistono
+                dati_calc_str = st.session_state.dati_calc if "dati_calc" in st.session_state else "Nessun dato economico."
+                
+                # Solo gli estratti rilevanti per la domanda, non l'intero fascicolo
+                doc_index = st.session_state.doc_index
+                rag_parts = doc_index.select(prompt, config.RAG_TOKEN_BUDGET_CHAT) if doc_index else []
+                
+                # Streaming: titolo e contenuto appaiono man mano che arrivano i token
+                chat_stream = ai_engine.interroga_gemini_stream(
+                    selected_chat_model,       # <--- USA IL MODELLO SCELTO DALL'UTENTE
+                    prompt, 
+                    st.session_state.chat_memory.render(selected_chat_model),
+                    rag_parts, 
+                    dati_calc_str, 
+                    st.session_state.sanitizer,
+                    "Listino Standard",        # Placeholder per pricing info
+                    aggression_level           # <--- USA L'AGGRESSIVITÀ DELLO SLIDER
+                )
+                st.write_stream(chat_stream)
+                resp_data = chat_stream.result()
                 
                 ai_content = resp_data.get("contenuto", "Errore generazione.")
                 ai_title = resp_data.get("titolo", "Risposta")
-                
-                # Visualizzazione
                 final_view = f"### {ai_title}\n\n{ai_content}"
-                st.markdown(final_view)
                 
                 # Aggiornamento memoria
                 st.session_state.messages.append({"role":"assistant", "content": final_view})
-                st.session_state.contesto_chat += f"\nAI: {ai_content}"
+                st.session_state.chat_memory.add("AI", ai_content)
+                # Persistenza del turno (un INSERT per domanda + risposta)
+                turno = st.session_state.messages[-2:]
+                for m, row in zip(turno, database.salva_messaggi(supabase, f_curr['id'], turno)):
+                    m["id"] = row.get("id")
+                # Compattazione: i turni vecchi finiscono nel riassunto, il contesto resta entro budget
+                st.session_state.chat_memory.compact(selected_chat_model, ai_engine.riassumi_contesto)
                 
                 # Bottone Rapido per passare alla generazione (se rilevato intento strategico)
                 if resp_data.get("fase") == "strategia":
@@ -287,11 +390,8 @@ with t3:
     
     with c_conf1:
         st.write("### 🧠 Motore AI")
-        try:
-            # Recupera modelli e moltiplicatori dalla tabella gemini_models
-            active_models = supabase.table("gemini_models").select("*").eq("is_active", True).execute().data
-        except: 
-            active_models = []
+        # Recupera modelli e moltiplicatori dalla tabella gemini_models (cache dati di riferimento)
+        active_models = database.get_active_gemini_models(supabase)
             
         if active_models:
             # Mappa per selectbox: "Nome Visualizzato" -> Oggetto Modello
@@ -323,7 +423,7 @@ with t3:
         totale_stimato_min = 0.0
         dettaglio_costi = []
         
-        # Recuperiamo il listino completo (Cached se possibile, qui diretto)
+        # Recuperiamo il listino completo (dalla cache dati di riferimento)
         listino = database.get_listino_completo(supabase)
         
         for d_name in sel:
@@ -392,6 +492,20 @@ with t3:
 
     # ... (Codice esistente preventivo stimato visuale... puoi lasciarlo come stima) ...
     
+    # --- DOWNLOAD ULTIMO BUNDLE ---
+    bundle = st.session_state.generated_docs_zip
+    if st.session_state.workflow_step == "DONE" and bundle:
+        st.success(f"✅ {bundle.n_docs} documenti pronti ({bundle.size / 1024:,.0f} KB).")
+        # download_button accetta solo bytes/BytesIO/file bufferizzati: i byte vengono
+        # comunque materializzati dal bottone, qui li leggiamo dal file temporaneo
+        st.download_button(
+            "📥 Scarica Documenti (ZIP)",
+            data=bundle.read_bytes(),
+            file_name=f"{f_curr['nome_riferimento']}_documenti.zip",
+            mime="application/zip",
+            type="primary"
+        )
+
     # --- PROCESSO DI GENERAZIONE MODIFICATO ---
     if st.session_state.workflow_step == "GENERATING":
         prog = st.progress(0, "Inizializzazione AI...")
@@ -404,51 +518,50 @@ with t3:
                 meta = "Genera il documento specifico richiesto..."
             tasks.append((d, meta))
             
-        # B. Recupero Chat History
-        hist_txt = "\n".join([f"{m['role']}: {m['content']}" for m in st.session_state.messages])
+        # B. Recupero Chat History (completa per la trascrizione, compattata per il modello)
+        hist_msgs = st.session_state.messages
+        if supabase and st.session_state.chat_has_more:
+            hist_msgs, _ = database.carica_messaggi(supabase, f_curr['id'])
+        hist_txt = "\n".join([f"{m['role']}: {m['content']}" for m in hist_msgs])
+        ctx_txt = st.session_state.chat_memory.render(SELECTED_MODEL_ID)
         
-        # C. Generazione (Passando il MODELLO SELEZIONATO)
+        # C. Generazione parallela (Passando il MODELLO SELEZIONATO)
+        def _on_doc_done(n_done, n_tot, d_name):
+            prog.progress(int(60 * n_done / n_tot), f"Generato {d_name} ({n_done}/{n_tot})")
+
         res_docs = ai_engine.genera_docs_json_batch(
-            tasks, hist_txt, [], st.session_state.dati_calc, SELECTED_MODEL_ID
+            tasks, ctx_txt, st.session_state.doc_index or [], st.session_state.dati_calc, SELECTED_MODEL_ID,
+            progress_cb=_on_doc_done, sanitizer=st.session_state.sanitizer
         )
         
         prog.progress(60, "Calcolo Prezzi e Salvataggio...")
         
         # D. Calcolo Pricing Reale e Aggiornamento DB
         if supabase:
-            # Recuperiamo storico attuale per appendere
-            # Nota: per semplicità facciamo una logica di update robusta
-            res_fascicolo = supabase.table("fascicoli").select("documenti_generati, costo_stimato").eq("id", f_curr['id']).execute()
-            current_docs = res_fascicolo.data[0].get("documenti_generati") or []
-            if not isinstance(current_docs, list): current_docs = []
+            # Solo i nuovi documenti e il delta di costo: il totale lo somma il DB
+            costo_delta = 0.0
+            nuovi_docs = []
             
-            current_cost = float(res_fascicolo.data[0].get("costo_stimato") or 0.0)
+            # Pricing di tutto il batch in un colpo (listino e moltiplicatore letti una volta)
+            prezzi_docs = database.registra_transazioni_batch(supabase, f_curr['id'], res_docs, SELECTED_MODEL_ID)
             
             # Iteriamo sui documenti generati dall'AI
             for doc_key, doc_data in res_docs.items():
-                # Estraiamo le metriche che abbiamo iniettato in ai_engine
-                metrics = doc_data.pop("_metrics", {"tokens_input": 0, "tokens_output": 0})
-                
-                # Calcoliamo il prezzo preciso
-                prezzo_doc, snapshot_partial = database.registra_transazione_doc(
-                    supabase, 
-                    f_curr['id'], 
-                    doc_key, 
-                    SELECTED_MODEL_ID, 
-                    metrics['tokens_input'], 
-                    metrics['tokens_output']
-                )
+                # Le metriche iniettate in ai_engine non devono finire nello ZIP
+                doc_data.pop("_metrics", None)
+                prezzo_doc, snapshot_partial = prezzi_docs.get(doc_key, (0.0, {}))
                 
                 # Completiamo lo snapshot con il contenuto reale
+                snapshot_partial.setdefault("titolo", doc_key)
                 snapshot_partial["contenuto"] = doc_data.get("contenuto", "")
                 
                 # Aggiungiamo alla lista e al totale
-                current_docs.append(snapshot_partial)
-                current_cost += prezzo_doc
+                nuovi_docs.append(snapshot_partial)
+                costo_delta += prezzo_doc
                 
             # Aggiungiamo anche la trascrizione chat (costo 0 o a piacere)
             chat_doc_title = f"Trascrizione_Chat_{datetime.now().strftime('%d%m_%H%M')}"
-            current_docs.append({
+            nuovi_docs.append({
                 "titolo": chat_doc_title,
                 "contenuto": f"# TRASCRIZIONE\n\n{hist_txt}",
                 "tipo": "trascrizione_chat",
@@ -456,21 +569,33 @@ with t3:
                 "metadata_pricing": {"final_price": 0.0} # Gratis
             })
 
-            # SALVATAGGIO UNICO NEL DB
-            supabase.table("fascicoli").update({
-                "documenti_generati": current_docs,
-                "costo_stimato": current_cost
-            }).eq("id", f_curr['id']).execute()
+            # SALVATAGGIO: append documenti + incremento costo atomici, un solo round-trip
+            try:
+                nuovo_costo = database.append_generazione(supabase, f_curr['id'], nuovi_docs, costo_delta)
+            except Exception as e:
+                # Esito incerto (es. timeout dopo il commit): niente secondo tentativo automatico
+                nuovo_costo = None
+                st.error(f"Archiviazione non confermata ({e}): controlla lo storico prima di rigenerare.")
+            if nuovo_costo is not None: f_curr['costo_stimato'] = nuovo_costo
             
-            # Refresh stato locale
-            st.session_state.current_fascicolo['documenti_generati'] = current_docs
+            # La sessione di chat si chiude: la trascrizione è ora tra i documenti
+            database.archivia_messaggi(supabase, f_curr['id'])
+            
+            # Refresh stato locale (l'elenco metadati verrà riletto)
+            st.session_state.doc_list = None
 
         prog.progress(90, "Creazione ZIP...")
-        st.session_state.generated_docs_zip = doc_renderer.create_zip(res_docs, st.session_state.sanitizer)
+        # In sessione resta solo l'handle dello ZIP (file temporaneo), non i byte
+        if st.session_state.generated_docs_zip: st.session_state.generated_docs_zip.close()
+        st.session_state.generated_docs_zip = doc_renderer.create_zip(
+            res_docs, st.session_state.sanitizer, nome_studio=st.session_state.get("nome_studio")
+        )
         
         # F. Reset Sessione
         st.session_state.messages = [] 
-        st.session_state.contesto_chat = ""
+        st.session_state.chat_has_more = False
+        st.session_state.chat_visibili = config.CHAT_VISIBLE_MESSAGES
+        st.session_state.chat_memory = chat_memory.ChatMemory()
         st.session_state.workflow_step = "DONE"
         
         prog.progress(100, "Fatto!")
@@ -1,7 +1,7 @@
 # modules/admin.py
 import streamlit as st
 import time
-from . import utils
+from . import utils, ai_engine, database
 
 def render_admin_panel(supabase):
     st.markdown("## 🛠️ Admin Dashboard")
@@ -24,9 +24,8 @@ def render_admin_panel(supabase):
             c1.markdown(f"**{u['nome_studio']}** ({u['email']})")
             if c2.button("✅ APPROVA", key=u['id']):
                 supabase.table("profili_utenti").update({"stato_account": "attivo"}).eq("id", u['id']).execute()
-                utils.send_approval_email(u['email'])
-                st.toast("Utente attivato")
-                time.sleep(1)
+                ok, msg = utils.send_approval_email(u['email'])
+                st.toast("Utente attivato" if ok else f"Utente attivato (email non accodata: {msg})")
                 st.rerun()
 
     # --- TAB PREZZI ---
@@ -36,8 +35,7 @@ def render_admin_panel(supabase):
         st.caption("Definisci prezzi fissi e variabili per ogni tipo di documento.")
         
         # 1. Recupera listino attuale dal DB
-        db_prices_list = supabase.table("listino_prezzi").select("*").execute().data
-        db_map = {row['tipo_documento']: row for row in db_prices_list}
+        db_map = database.get_listino_completo(supabase)
         
         # 2. Elenco di tutti i documenti gestiti (da Config + Jolly)
         from . import config # Import locale per sicurezza
@@ -75,6 +73,7 @@ def render_admin_panel(supabase):
                             supabase.table("listino_prezzi").update(upsert_data).eq("id", row_data['id']).execute()
                         else:
                             supabase.table("listino_prezzi").insert(upsert_data).execute()
+                        database.invalida_cache_riferimento("listino_prezzi")
                         
                         st.success(f"Aggiornato: {doc_type}")
                         time.sleep(1)
@@ -84,3 +83,36 @@ def render_admin_panel(supabase):
     with t_audit:
         fascicoli = supabase.table("fascicoli").select("*").order("created_at", desc=True).limit(20).execute().data
         st.dataframe(fascicoli)
+
+        if hasattr(supabase, "stats"):
+            with st.expander("💾 Database Locale (SQLite)"):
+                st.json(supabase.stats())
+
+        with st.expander("🔌 Pool Connessioni Gemini"):
+            st.json(ai_engine.get_client_pool_stats())
+
+        with st.expander("📚 Cache Dati di Riferimento"):
+            st.json(database.get_ref_cache().stats())
+            if st.button("Ricarica Listino e Modelli"):
+                database.invalida_cache_riferimento()
+                st.toast("Cache invalidata")
+
+        with st.expander("✍️ Scritture Differite Fascicoli"):
+            st.json(database.get_write_buffer().stats())
+            if st.button("Scarica Ora"):
+                st.toast(f"{database.flush_fascicoli(supabase)} fascicoli aggiornati")
+
+        with st.expander("📧 Outbox Email"):
+            box = utils.get_outbox()
+            if box is None:
+                st.caption("SMTP non configurato.")
+            else:
+                st.json(box.stats())
+                if st.button("Riprova Email Fallite"):
+                    st.toast(f"{box.retry_failed()} email rimesse in coda")
+
+        with st.expander("🗃️ Cache Risposte AI"):
+            st.json(ai_engine.get_cache_stats())
+            if st.button("Svuota Cache AI"):
+                ai_engine.get_response_cache().clear()
+                st.toast("Cache svuotata")
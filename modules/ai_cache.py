@@ -0,0 +1,169 @@
+# modules/ai_cache.py
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from . import config
+
+# --- 1. CHIAVE CONTENT-ADDRESSED ---
+def _config_fingerprint(conf):
+    """Serializzazione stabile della GenerateContentConfig"""
+    if conf is None: return None
+    for attr in ("model_dump", "dict"):
+        fn = getattr(conf, attr, None)
+        if fn:
+            try: return fn(exclude_none=True, mode="json") if attr == "model_dump" else fn(exclude_none=True)
+            except TypeError: return fn()
+    return repr(conf)
+
+def make_key(model, conf, prompt):
+    """SHA-256 di modello + config + prompt completo"""
+    payload = json.dumps(
+        {"model": model, "config": _config_fingerprint(conf), "prompt": prompt},
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# --- 2. BACKEND ---
+class MemoryLRUBackend:
+    """LRU in memoria di processo (thread-safe)"""
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None: return None
+            self._data.move_to_end(key)
+            return item
+
+    def set(self, key, created_at, value):
+        with self._lock:
+            self._data[key] = (created_at, value)
+            self._data.move_to_end(key)
+            evicted = 0
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def delete(self, key):
+        with self._lock: self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock: self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class SQLiteBackend:
+    """Cache su disco (sopravvive ai riavvii del server), eviction LRU per numero voci"""
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ai_cache ("
+            " key TEXT PRIMARY KEY, created_at REAL, last_access REAL, value TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ai_cache_lru ON ai_cache(last_access)")
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT created_at, value FROM ai_cache WHERE key = ?", (key,)).fetchone()
+            if row is None: return None
+            self._conn.execute("UPDATE ai_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0], json.loads(row[1])
+
+    def set(self, key, created_at, value):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ai_cache(key, created_at, last_access, value) VALUES (?, ?, ?, ?)",
+                (key, created_at, time.time(), json.dumps(value, ensure_ascii=False))
+            )
+            cur = self._conn.execute(
+                "DELETE FROM ai_cache WHERE key IN ("
+                " SELECT key FROM ai_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+            return cur.rowcount or 0
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM ai_cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM ai_cache")
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM ai_cache").fetchone()[0]
+
+# --- 3. CACHE ---
+class ResponseCache:
+    """
+    Cache delle risposte Gemini con TTL e contatori hit/miss.
+    Valore salvato: {"text": ..., "tokens_input": ..., "tokens_output": ...}
+    """
+    def __init__(self, backend, ttl_seconds):
+        self.backend = backend
+        self.ttl = ttl_seconds
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0, "stores": 0}
+
+    def _count(self, name, n=1):
+        with self._lock: self._stats[name] += n
+
+    def get(self, key):
+        item = self.backend.get(key)
+        if item is None:
+            self._count("misses")
+            return None
+        created_at, value = item
+        if self.ttl and time.time() - created_at > self.ttl:
+            self.backend.delete(key)
+            self._count("expired")
+            self._count("misses")
+            return None
+        self._count("hits")
+        return value
+
+    def set(self, key, value):
+        self._count("evicted", self.backend.set(key, time.time(), value))
+        self._count("stores")
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self._lock: out = dict(self._stats)
+        tot = out["hits"] + out["misses"]
+        out["hit_rate"] = round(out["hits"] / tot, 3) if tot else 0.0
+        out["entries"] = len(self.backend)
+        out["backend"] = type(self.backend).__name__
+        return out
+
+def build_cache(backend=None, ttl_seconds=None, max_entries=None):
+    """Crea la cache secondo config (backend sostituibile)"""
+    backend = backend or config.AI_CACHE_BACKEND
+    max_entries = max_entries or config.AI_CACHE_MAX_ENTRIES
+    ttl = config.AI_CACHE_TTL_SECONDS if ttl_seconds is None else ttl_seconds
+    if backend == "sqlite":
+        try:
+            return ResponseCache(SQLiteBackend(config.AI_CACHE_SQLITE_PATH, max_entries), ttl)
+        except Exception as e:
+            print(f"Cache SQLite non disponibile, uso memoria: {e}")
+    return ResponseCache(MemoryLRUBackend(max_entries), ttl)
@@ -1,9 +1,13 @@
 import re
 import json
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import streamlit as st
 from google import genai
 from google.genai import types
-from . import config
+from . import config, ai_cache, telemetry
 
 # --- 1. CONFIGURAZIONE AI ---
 def init_ai():
@@ -11,14 +15,145 @@ def init_ai():
     if "GOOGLE_API_KEY" not in st.secrets:
         st.warning("⚠️ Google API Key mancante nei secrets.")
 
+class GenAIClientRegistry:
+    """
+    Registro process-wide dei client GenAI (uno per API key).
+    Il client è condiviso tra tutte le sessioni Streamlit del server, così le
+    connessioni HTTP keep-alive (e il TLS) restano calde tra un rerun e l'altro.
+    """
+    def __init__(self, pool_size=None, keepalive=None):
+        self.pool_size = int(pool_size or config.GENAI_POOL_SIZE)
+        self.keepalive = int(keepalive or config.GENAI_POOL_KEEPALIVE)
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._stats = {"clients_created": 0, "checkouts": 0, "requests": 0, "responses": 0, "errors": 0, "in_flight": 0, "peak_in_flight": 0}
+
+    @contextmanager
+    def in_volo(self):
+        """
+        Conta una chiamata SDK in volo per tutta la sua durata (stream compresi),
+        con il decremento nel finally: errori e stream chiusi in anticipo non lo sbilanciano.
+        """
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["in_flight"] += 1
+            self._stats["peak_in_flight"] = max(self._stats["peak_in_flight"], self._stats["in_flight"])
+        esito = None   # None: stream chiuso da chi legge, non conta come risposta né errore
+        try:
+            yield
+            esito = "responses"
+        except Exception:
+            esito = "errors"
+            raise
+        finally:
+            with self._lock:
+                self._stats["in_flight"] -= 1
+                if esito: self._stats[esito] += 1
+
+    def _build(self, api_key):
+        try:
+            import httpx
+            client_args = {
+                "limits": httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.keepalive,
+                    keepalive_expiry=config.GENAI_POOL_KEEPALIVE_EXPIRY
+                )
+            }
+            return genai.Client(api_key=api_key, http_options=types.HttpOptions(client_args=client_args))
+        except Exception as e:
+            # SDK vecchio senza client_args: client condiviso ma pool di default
+            print(f"Pool HTTP personalizzato non disponibile: {e}")
+            return genai.Client(api_key=api_key)
+
+    def get(self, api_key):
+        with self._lock:
+            self._stats["checkouts"] += 1
+            client = self._clients.get(api_key)
+            if client is None:
+                client = self._build(api_key)
+                self._clients[api_key] = client
+                self._stats["clients_created"] += 1
+            return client
+
+    def stats(self):
+        """Statistiche di utilizzo del pool (per debug/admin)"""
+        with self._lock:
+            out = dict(self._stats)
+        out["pool_size"] = self.pool_size
+        out["keepalive"] = self.keepalive
+        out["utilizzo_pool"] = round(out["in_flight"] / self.pool_size, 2) if self.pool_size else 0.0
+        return out
+
+@st.cache_resource
+def get_client_registry():
+    """Un solo registro per processo server"""
+    return GenAIClientRegistry()
+
 def get_client():
-    """Inizializza il nuovo Client Google GenAI"""
+    """Restituisce il Client Google GenAI condiviso (pool di connessioni keep-alive)"""
     try:
-        return genai.Client(api_key=st.secrets["GOOGLE_API_KEY"])
+        return get_client_registry().get(st.secrets["GOOGLE_API_KEY"])
     except Exception as e:
         print(f"Errore Init Client: {e}")
         return None
 
+def get_client_pool_stats():
+    """Statistiche del pool di connessioni GenAI"""
+    return get_client_registry().stats()
+
+# --- 1b. CACHE RISPOSTE ---
+@st.cache_resource
+def get_response_cache():
+    """Cache risposte condivisa dal processo (backend da config)"""
+    return ai_cache.build_cache()
+
+def get_cache_stats():
+    return get_response_cache().stats()
+
+def _generate_cached(client, active_model, conf, full_prompt, use_cache=True, validate=None):
+    """
+    generate_content con cache content-addressed (modello + config + prompt).
+    Restituisce {"text", "tokens_input", "tokens_output", "cached"}.
+    Le risposte vengono salvate solo se validate(text) è vero (niente cache degli errori).
+    """
+    t0 = time.perf_counter()
+    cache = get_response_cache() if (use_cache and config.AI_CACHE_ENABLED) else None
+    key = None
+    if cache:
+        key = ai_cache.make_key(active_model, conf, full_prompt)
+        hit = cache.get(key)
+        if hit is not None:
+            telemetry.record("ai", f"{active_model} (cache)", time.perf_counter() - t0, len(hit.get("text") or ""))
+            return dict(hit, cached=True)
+
+    try:
+        with get_client_registry().in_volo():
+            response = client.models.generate_content(
+                model=active_model,
+                contents=full_prompt,
+                config=conf
+            )
+    except Exception:
+        telemetry.record("ai", active_model, time.perf_counter() - t0, len(full_prompt), error=True)
+        raise
+    
+    # Recupero Token (Nuova sintassi usage_metadata)
+    t_in, t_out = 0, 0
+    if response.usage_metadata:
+        t_in = response.usage_metadata.prompt_token_count
+        t_out = response.usage_metadata.candidates_token_count
+
+    out = {"text": response.text, "tokens_input": t_in, "tokens_output": t_out}
+    telemetry.record("ai", active_model, time.perf_counter() - t0,
+                     len(full_prompt) + len(out["text"] or ""), (t_in or 0) + (t_out or 0))
+    if cache and (validate is None or validate(out["text"])):
+        cache.set(key, out)
+    return dict(out, cached=False)
+
+def _is_json_dict(text):
+    return isinstance(clean_json_text(text), dict)
+
 def get_best_model():
     """
     Restituisce il nome del modello migliore da usare.
@@ -40,10 +175,21 @@ def get_active_models_list():
 
 # --- 2. PRIVACY SHIELD ---
 class DataSanitizer:
-    def __init__(self):
+    """
+    Mascheramento nomi con un unico matcher regex precompilato.
+    I pattern (nomi e placeholder) vengono ricompilati solo quando add() modifica il mapping;
+    sanitize e restore fanno una sola passata lineare sul testo.
+    case_insensitive=False: come prima, match esatto o TUTTO MAIUSCOLO.
+    case_insensitive=True: qualsiasi variante di maiuscole/minuscole.
+    """
+    def __init__(self, case_insensitive=False):
         self.mapping = {}
         self.reverse = {}
         self.cnt = 1
+        self.case_insensitive = case_insensitive
+        self._matcher = None
+        self._restorer = None
+        self._lookup = {}
 
     def add(self, real, label):
         if real and real not in self.mapping:
@@ -51,18 +197,45 @@ class DataSanitizer:
             self.mapping[real] = fake
             self.reverse[fake] = real
             self.cnt += 1
+            self._matcher = None  # invalida i pattern compilati
+            self._restorer = None
+
+    def _compile(self):
+        lookup = {}
+        sources = []
+        for r, f in self.mapping.items():
+            if self.case_insensitive:
+                # casefold solo come chiave: può cambiare la stringa ('Straße' -> 'strasse'),
+                # quindi il pattern resta costruito sugli originali
+                lookup.setdefault(r.casefold(), f)
+                sources.append(r)
+            else:
+                lookup.setdefault(r, f)
+                lookup.setdefault(r.upper(), f)
+        if not self.case_insensitive: sources = list(lookup)
+        # Più lunghi prima: 'Mario Rossi' deve vincere su 'Mario'
+        alternation = "|".join(re.escape(k) for k in sorted(set(sources), key=len, reverse=True))
+        flags = re.IGNORECASE if self.case_insensitive else 0
+        self._matcher = re.compile(alternation, flags) if alternation else None
+        self._lookup = lookup
+
+    def _replace(self, m):
+        k = m.group(0)
+        return self._lookup.get(k.casefold() if self.case_insensitive else k, k)
 
     def sanitize(self, txt):
         if not txt: return ""
-        for r, f in self.mapping.items():
-            txt = txt.replace(r, f).replace(r.upper(), f)
-        return txt
+        if not self.mapping: return txt
+        if self._matcher is None: self._compile()
+        return self._matcher.sub(self._replace, txt)
 
     def restore(self, txt):
         if not txt: return ""
-        for f, r in self.reverse.items():
-            txt = txt.replace(f, r)
-        return txt
+        if not self.reverse: return txt
+        # Dalle chiavi reali: le etichette possono contenere spazi o accenti ('CONTROPARTE PRINCIPALE')
+        if self._restorer is None:
+            self._restorer = re.compile("|".join(re.escape(f) for f in sorted(self.reverse, key=len, reverse=True)))
+        return self._restorer.sub(lambda m: self.reverse.get(m.group(0), m.group(0)), txt)
 
 # --- 3. JSON PARSER ROBUSTO ---
 def clean_json_text(text):
@@ -105,10 +278,17 @@ def stima_costo_token(context_text, num_docs, pricing_row):
     return max(5.0, round(totale, 2))
 
 # --- 5. CHAT STRATEGICA (TAB 2) ---
-def interroga_gemini(model_name, prompt, context, file_parts, calc_data, sanitizer, pricing_info, aggression_level):
-    client = get_client()
-    if not client: return {"fase": "errore", "titolo": "Errore Client", "contenuto": "API Key non valida."}
+def _format_doc_excerpts(file_parts, sanitizer=None):
+    """
+    Estratti documentali da inserire nel prompt.
+    file_parts: lista di stringhe (es. chunk selezionati da retrieval.BM25Index.select).
+    """
+    if not file_parts: return ""
+    txt = "\n\n".join(p for p in file_parts if isinstance(p, str))
+    return sanitizer.sanitize(txt) if sanitizer else txt
 
+def _build_chat_request(model_name, prompt, context, calc_data, pricing_info, aggression_level, file_parts=None, sanitizer=None):
+    """Prepara (modello, config, prompt) condivisi tra chat sincrona e streaming"""
     # Pulizia nome modello (la nuova lib non vuole 'models/')
     active_model = model_name.replace("models/", "") if model_name else "gemini-1.5-flash"
     
@@ -125,12 +305,14 @@ def interroga_gemini(model_name, prompt, context, file_parts, calc_data, sanitiz
     )
 
     # Costruzione Prompt
-    # La nuova lib gestisce i file diversamente, per ora passiamo tutto come testo nel prompt per semplicità
-    # Se file_parts contiene oggetti complessi, andrebbero gestiti, ma qui assumiamo siano stringhe estratte o gestite
+    # I documenti arrivano come estratti testuali già selezionati (retrieval), non il file intero
+    docs_txt = _format_doc_excerpts(file_parts, sanitizer)
+    docs_block = f"ESTRATTI DOCUMENTI FASCICOLO:\n{docs_txt}\n" if docs_txt else ""
     
     full_prompt = f"""
     RUOLO: Senior Legal Strategist.
     CONTESTO: {context}
+    {docs_block}
     DATI: {calc_data}
     BUDGET: {pricing_info}
     AGGRESSIVITÀ: {aggression_level}/10.
@@ -138,19 +320,24 @@ def interroga_gemini(model_name, prompt, context, file_parts, calc_data, sanitiz
     
     OUTPUT JSON: {{ "fase": "strategia", "titolo": "...", "contenuto": "..." }}
     """
+    return active_model, conf, full_prompt
+
+def interroga_gemini(model_name, prompt, context, file_parts, calc_data, sanitizer, pricing_info, aggression_level, use_cache=True):
+    client = get_client()
+    if not client: return {"fase": "errore", "titolo": "Errore Client", "contenuto": "API Key non valida."}
+
+    active_model, conf, full_prompt = _build_chat_request(
+        model_name, prompt, context, calc_data, pricing_info, aggression_level, file_parts, sanitizer
+    )
     
     try:
-        # Nuova chiamata API: client.models.generate_content
-        response = client.models.generate_content(
-            model=active_model,
-            contents=full_prompt,
-            config=conf
-        )
+        # Nuova chiamata API: client.models.generate_content (via cache)
+        gen = _generate_cached(client, active_model, conf, full_prompt, use_cache, validate=_is_json_dict)
         
-        parsed = clean_json_text(response.text)
+        parsed = clean_json_text(gen["text"])
         
         if parsed is None:
-             fallback_content = response.text[:2000]
+             fallback_content = gen["text"][:2000]
              return {"fase": "strategia", "titolo": "Risposta (Raw)", "contenuto": fallback_content}
 
         if "contenuto" in parsed: parsed["contenuto"] = sanitizer.restore(parsed["contenuto"])
@@ -161,67 +348,343 @@ def interroga_gemini(model_name, prompt, context, file_parts, calc_data, sanitiz
     except Exception as e:
         return {"fase": "errore", "titolo": "Errore GenAI", "contenuto": str(e)}
 
+class JsonEnvelopeStreamParser:
+    """
+    Parser incrementale dell'envelope { "fase", "titolo", "contenuto" }.
+    Riceve i chunk grezzi dello stream e decodifica le stringhe JSON man mano,
+    restituendo solo il delta di 'contenuto' appena disponibile.
+    """
+    KEY_RE = re.compile(r'"(fase|titolo|contenuto)"\s*:\s*"')
+    ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self):
+        self.buf = ""
+        self.pos = 0
+        self.key = None  # chiave della stringa in lettura (None = fuori stringa)
+        self.fields = {}
+        self.closed = set()
+
+    def feed(self, chunk):
+        self.buf += chunk or ""
+        delta = []
+        while True:
+            if self.key is None:
+                m = self.KEY_RE.search(self.buf, self.pos)
+                if not m: break
+                self.key = m.group(1)
+                self.fields.setdefault(self.key, "")
+                self.pos = m.end()
+                continue
+
+            # Dentro la stringa: consumiamo fino a fine buffer o virgolette di chiusura
+            out = []
+            finished = False
+            while self.pos < len(self.buf):
+                ch = self.buf[self.pos]
+                if ch == '\\':
+                    if self.pos + 1 >= len(self.buf): break  # escape spezzato tra due chunk
+                    nxt = self.buf[self.pos + 1]
+                    if nxt == 'u':
+                        if self.pos + 6 > len(self.buf): break
+                        try: code = int(self.buf[self.pos + 2:self.pos + 6], 16)
+                        except ValueError: code = None
+                        if code is not None and 0xD800 <= code <= 0xDBFF:
+                            # Coppia surrogata (emoji ecc.): serve anche il \uDC00-\uDFFF che segue
+                            low = self.buf[self.pos + 6:self.pos + 12]
+                            if len(low) < 6 and "\\u".startswith(low[:2]): break
+                            try: low_code = int(low[2:], 16) if low.startswith("\\u") else None
+                            except ValueError: low_code = None
+                            if low_code is not None and 0xDC00 <= low_code <= 0xDFFF:
+                                out.append(chr(0x10000 + ((code - 0xD800) << 10) + (low_code - 0xDC00)))
+                                self.pos += 12
+                                continue
+                            code = 0xFFFD
+                        elif code is not None and 0xDC00 <= code <= 0xDFFF:
+                            code = 0xFFFD  # surrogato isolato: non codificabile in UTF-8
+                        if code is not None: out.append(chr(code))
+                        self.pos += 6
+                    else:
+                        out.append(self.ESCAPES.get(nxt, nxt))
+                        self.pos += 2
+                    continue
+                if ch == '"':
+                    self.pos += 1
+                    finished = True
+                    break
+                out.append(ch)
+                self.pos += 1
+
+            txt = "".join(out)
+            self.fields[self.key] += txt
+            if self.key == "contenuto": delta.append(txt)
+            if not finished: break
+            self.closed.add(self.key)
+            self.key = None
+        return "".join(delta)
+
+    def has(self, key):
+        return key in self.closed
+
+class _PlaceholderRestorer:
+    """
+    Ripristina i placeholder del DataSanitizer su testo in streaming.
+    Trattiene la coda del testo che potrebbe essere un placeholder spezzato (es. '[CLIEN').
+    """
+    def __init__(self, sanitizer):
+        self.sanitizer = sanitizer
+        self.max_len = max((len(f) for f in getattr(sanitizer, "reverse", {})), default=0)
+        self.pending = ""
+
+    def push(self, txt):
+        self.pending += txt
+        cut = len(self.pending)
+        if self.max_len:
+            idx = self.pending.rfind('[')
+            if idx != -1 and ']' not in self.pending[idx:] and len(self.pending) - idx < self.max_len:
+                cut = idx
+        ready, self.pending = self.pending[:cut], self.pending[cut:]
+        return self.sanitizer.restore(ready) if ready else ""
+
+    def flush(self):
+        ready, self.pending = self.pending, ""
+        return self.sanitizer.restore(ready) if ready else ""
+
+class ChatStream:
+    """
+    Iterabile compatibile con st.write_stream: produce il testo di 'contenuto'
+    già de-anonimizzato. Se with_title=True, il primo chunk è '### {titolo}'.
+    A fine iterazione result() restituisce lo stesso dict di interroga_gemini.
+    """
+    def __init__(self, client, active_model, conf, full_prompt, sanitizer, with_title=True):
+        self.client = client
+        self.active_model = active_model
+        self.conf = conf
+        self.full_prompt = full_prompt
+        self.sanitizer = sanitizer
+        self.with_title = with_title
+        self.fase = None
+        self.titolo = None
+        self.contenuto = ""
+        self.metrics = {"tokens_input": 0, "tokens_output": 0}
+
+    def __iter__(self):
+        parser = JsonEnvelopeStreamParser()
+        restorer = _PlaceholderRestorer(self.sanitizer)
+        header_sent = not self.with_title
+        raw = []
+
+        if not self.client:
+            self.fase, self.titolo, self.contenuto = "errore", "Errore Client", "API Key non valida."
+            yield f"### {self.titolo}\n\n{self.contenuto}"
+            return
+
+        t0 = time.perf_counter()
+        try:
+            # In volo finché lo stream resta aperto (anche se chi legge si ferma prima)
+            with get_client_registry().in_volo():
+                stream = self.client.models.generate_content_stream(
+                    model=self.active_model,
+                    contents=self.full_prompt,
+                    config=self.conf
+                )
+                for chunk in stream:
+                    if getattr(chunk, "usage_metadata", None):
+                        self.metrics = {
+                            "tokens_input": chunk.usage_metadata.prompt_token_count or 0,
+                            "tokens_output": chunk.usage_metadata.candidates_token_count or 0
+                        }
+                    piece = chunk.text or ""
+                    raw.append(piece)
+                    delta = parser.feed(piece)
+
+                    if parser.has("fase"): self.fase = parser.fields["fase"]
+                    if parser.has("titolo"): self.titolo = self.sanitizer.restore(parser.fields["titolo"])
+
+                    # Il titolo va emesso prima del primo pezzo di contenuto
+                    if not header_sent and (self.titolo is not None or "contenuto" in parser.fields):
+                        header_sent = True
+                        yield f"### {self.titolo or 'Risposta'}\n\n"
+
+                    out = restorer.push(delta) if delta else ""
+                    if out:
+                        self.contenuto += out
+                        yield out
+        except Exception as e:
+            telemetry.record("ai", f"{self.active_model} (stream)", time.perf_counter() - t0, len(self.full_prompt), error=True)
+            self.fase, self.titolo = "errore", "Errore GenAI"
+            tail = restorer.flush() + f"\n\n{e}"
+            self.contenuto += tail
+            yield tail
+            return
+
+        telemetry.record(
+            "ai", f"{self.active_model} (stream)", time.perf_counter() - t0,
+            len(self.full_prompt) + sum(len(p) for p in raw),
+            self.metrics["tokens_input"] + self.metrics["tokens_output"]
+        )
+        tail = restorer.flush()
+        if tail:
+            self.contenuto += tail
+            yield tail
+
+        # Fallback: il modello non ha rispettato l'envelope JSON
+        if "contenuto" not in parser.fields:
+            full_raw = "".join(raw)
+            parsed = clean_json_text(full_raw)
+            if isinstance(parsed, dict) and "contenuto" in parsed:
+                self.fase = parsed.get("fase", self.fase)
+                self.titolo = self.sanitizer.restore(parsed.get("titolo", "Risposta"))
+                self.contenuto = self.sanitizer.restore(parsed["contenuto"])
+            else:
+                self.fase, self.titolo = "strategia", "Risposta (Raw)"
+                self.contenuto = full_raw[:2000]
+            if not header_sent: yield f"### {self.titolo}\n\n"
+            yield self.contenuto
+
+    def result(self):
+        return {
+            "fase": self.fase or "strategia",
+            "titolo": self.titolo or "Risposta",
+            "contenuto": self.contenuto,
+            "_metrics": self.metrics
+        }
+
+def interroga_gemini_stream(model_name, prompt, context, file_parts, calc_data, sanitizer, pricing_info, aggression_level, with_title=True):
+    """
+    Variante streaming di interroga_gemini (stessa firma).
+    Restituisce un ChatStream da passare a st.write_stream; poi .result() per il dict finale.
+    """
+    client = get_client()
+    if not client: return ChatStream(None, None, None, None, sanitizer, with_title)
+
+    active_model, conf, full_prompt = _build_chat_request(
+        model_name, prompt, context, calc_data, pricing_info, aggression_level, file_parts, sanitizer
+    )
+    return ChatStream(client, active_model, conf, full_prompt, sanitizer, with_title)
+
+@telemetry.traccia("ai", "riassunto_chat", bytes_of=lambda s: len(s or ""))
+def riassumi_contesto(summary, turns_text, max_tokens):
+    """
+    Aggiorna il riassunto incrementale della chat (usato da ChatMemory.compact).
+    Usa sempre il modello economico: il riassunto non richiede ragionamento Pro.
+    """
+    client = get_client()
+    if not client: return None
+
+    conf = types.GenerateContentConfig(temperature=0.2, max_output_tokens=int(max_tokens))
+    full_prompt = f"""
+    Aggiorna il RIASSUNTO di una consulenza legale integrando i NUOVI TURNI.
+    Conserva fatti, date, importi, nomi/placeholder, decisioni strategiche e richieste aperte.
+    Massimo {int(max_tokens * 0.7)} parole. Rispondi solo con il testo del riassunto.
+    RIASSUNTO ATTUALE: {summary or "(vuoto)"}
+    NUOVI TURNI:
+    {turns_text}
+    """
+    with get_client_registry().in_volo():
+        response = client.models.generate_content(model=get_best_model(), contents=full_prompt, config=conf)
+    return (response.text or "").strip()
+
 # --- 6. GENERATORE BATCH (TAB 3) ---
-def genera_docs_json_batch(tasks, context_chat, file_parts, calc_data, selected_model_name):
+def get_concurrency_limit(model_name):
+    """Limite di richieste parallele per il modello (da config)"""
+    active_model = model_name.replace("models/", "") if model_name else "gemini-1.5-flash"
+    return config.AI_CONCURRENCY_LIMITS.get(active_model, config.AI_CONCURRENCY_DEFAULT)
+
+def _genera_singolo_doc(client, active_model, task, context_chat, calc_data, use_cache=True, file_parts=None, sanitizer=None):
+    """
+    Genera un singolo documento. Non solleva mai eccezioni:
+    ogni errore resta confinato al proprio documento.
+    Restituisce: (doc_name, risultato_dict)
+    """
+    system_instruction = 'SEI UN GENERATORE DI API JSON. OUTPUT FORMAT: { "titolo": "...", "contenuto": "..." }'
+
+    if len(task) == 3:
+        doc_name, task_prompt, doc_temp = task
+    else:
+        doc_name, task_prompt = task
+        doc_temp = 0.7
+
+    conf = types.GenerateContentConfig(
+        temperature=float(doc_temp),
+        response_mime_type="application/json"
+    )
+    
+    # Estratti documentali: se file_parts è un indice, selezioniamo i chunk rilevanti per questo documento
+    if hasattr(file_parts, "select"):
+        query = f"{doc_name.replace('_', ' ')} {task_prompt} {str(context_chat)[-1000:]}"
+        file_parts = file_parts.select(query, config.RAG_TOKEN_BUDGET_DOC)
+    docs_txt = _format_doc_excerpts(file_parts, sanitizer)
+    docs_block = f"ESTRATTI DOCUMENTI FASCICOLO:\n{docs_txt}" if docs_txt else ""
+
+    full_prompt = f"""
+    {system_instruction}
+    CONTESTO: {context_chat}
+    {docs_block}
+    DATI: {calc_data}
+    OBIETTIVO: {doc_name}
+    ISTRUZIONI: {task_prompt}
+    """
+    
+    try:
+        gen = _generate_cached(client, active_model, conf, full_prompt, use_cache, validate=_is_json_dict)
+        # 'cached': True => nessun token consumato, non va fatturato come nuovo
+        metrics = {"tokens_input": gen["tokens_input"], "tokens_output": gen["tokens_output"], "cached": gen["cached"]}
+
+        cleaned_obj = clean_json_text(gen["text"])
+        
+        if isinstance(cleaned_obj, dict):
+            cleaned_obj["_metrics"] = metrics
+            return doc_name, cleaned_obj
+        return doc_name, {
+            "titolo": f"Errore {doc_name}", 
+            "contenuto": gen["text"],
+            "_metrics": metrics
+        }
+            
+    except Exception as e:
+        return doc_name, {
+            "titolo": "Errore Tecnico", 
+            "contenuto": str(e),
+            "_metrics": {"tokens_input": 0, "tokens_output": 0}
+        }
+
+def genera_docs_json_batch(tasks, context_chat, file_parts, calc_data, selected_model_name, max_workers=None, progress_cb=None, use_cache=True, sanitizer=None):
+    """
+    Genera i documenti in parallelo con un pool di thread limitato.
+    - max_workers: override del limite per modello (1 = sequenziale come prima).
+    - progress_cb(completati, totale, doc_name): chiamata dal thread principale
+      a ogni documento completato (sicura per aggiornare la UI Streamlit).
+    - use_cache: False forza la rigenerazione ignorando la cache risposte.
+    - file_parts: lista di estratti comuni a tutti i task, oppure un retrieval.BM25Index
+      (top-k chunk per ogni documento entro config.RAG_TOKEN_BUDGET_DOC).
+    - sanitizer: se presente, maschera i nomi negli estratti prima dell'invio.
+    Restituisce il dict {doc_name: {...}} nello stesso ordine dei task.
+    """
     client = get_client()
     if not client: return {}
 
     # Pulizia nome modello
     active_model = selected_model_name.replace("models/", "") if selected_model_name else "gemini-1.5-flash"
     
-    results = {}
-    system_instruction = 'SEI UN GENERATORE DI API JSON. OUTPUT FORMAT: { "titolo": "...", "contenuto": "..." }'
+    if not tasks: return {}
+    workers = max_workers or get_concurrency_limit(active_model)
+    workers = max(1, min(int(workers), len(tasks)))
 
-    for task in tasks:
-        if len(task) == 3:
-            doc_name, task_prompt, doc_temp = task
-        else:
-            doc_name, task_prompt = task
-            doc_temp = 0.7
-
-        conf = types.GenerateContentConfig(
-            temperature=float(doc_temp),
-            response_mime_type="application/json"
-        )
-        
-        full_prompt = f"""
-        {system_instruction}
-        CONTESTO: {context_chat}
-        DATI: {calc_data}
-        OBIETTIVO: {doc_name}
-        ISTRUZIONI: {task_prompt}
-        """
-        
-        try:
-            response = client.models.generate_content(
-                model=active_model,
-                contents=full_prompt,
-                config=conf
-            )
-            
-            # Recupero Token (Nuova sintassi usage_metadata)
-            t_in, t_out = 0, 0
-            if response.usage_metadata:
-                t_in = response.usage_metadata.prompt_token_count
-                t_out = response.usage_metadata.candidates_token_count
+    done = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="genai-batch") as pool:
+        futures = [
+            pool.submit(telemetry.propaga(_genera_singolo_doc), client, active_model, task, context_chat, calc_data, use_cache, file_parts, sanitizer)
+            for task in tasks
+        ]
+        for fut in as_completed(futures):
+            doc_name, data = fut.result()
+            done[doc_name] = data
+            if progress_cb:
+                try: progress_cb(len(done), len(tasks), doc_name)
+                except Exception: pass
 
-            cleaned_obj = clean_json_text(response.text)
-            
-            if isinstance(cleaned_obj, dict):
-                cleaned_obj["_metrics"] = {"tokens_input": t_in, "tokens_output": t_out}
-                results[doc_name] = cleaned_obj
-            else:
-                results[doc_name] = {
-                    "titolo": f"Errore {doc_name}", 
-                    "contenuto": response.text,
-                    "_metrics": {"tokens_input": t_in, "tokens_output": t_out}
-                }
-                
-        except Exception as e:
-            results[doc_name] = {
-                "titolo": "Errore Tecnico", 
-                "contenuto": str(e),
-                "_metrics": {"tokens_input": 0, "tokens_output": 0}
-            }
-            
+    # Ricostruiamo l'ordine originale dei task
+    results = {}
+    for task in tasks:
+        if task[0] in done: results[task[0]] = done[task[0]]
     return results
@@ -0,0 +1,113 @@
+# modules/chat_memory.py
+from . import config
+
+def stima_token(text):
+    """Stima grezza: ~4 caratteri per token (stessa euristica di stima_costo_token)"""
+    return len(text or "") // 4
+
+def get_context_budget(model_name):
+    active_model = model_name.replace("models/", "") if model_name else "gemini-1.5-flash"
+    return config.CHAT_CONTEXT_BUDGETS.get(active_model, config.CHAT_CONTEXT_BUDGET_DEFAULT)
+
+def _riassunto_estrattivo(summary, turns_text, max_tokens):
+    """Fallback senza AI: accoda e tiene la parte più recente entro il budget"""
+    merged = f"{summary}\n{turns_text}".strip() if summary else turns_text.strip()
+    max_chars = max_tokens * 4
+    return merged[-max_chars:] if len(merged) > max_chars else merged
+
+class ChatMemory:
+    """
+    Contesto della chat strategica con compattazione progressiva.
+    - I turni recenti restano alla lettera.
+    - I turni più vecchi vengono "piegati" una sola volta in un riassunto
+      mantenuto incrementalmente (riassunto precedente + nuovi turni).
+    - render() non supera mai il budget di token del modello.
+    """
+    def __init__(self):
+        self.turns = []        # [(ruolo, testo)] non ancora riassunti
+        self.summary = ""
+        self.n_folded = 0
+
+    @classmethod
+    def from_messages(cls, messages, model_name=None, summarizer=None):
+        """Ricostruisce la memoria dalla cronologia salvata (ruoli Streamlit: user/assistant)"""
+        mem = cls()
+        for m in messages:
+            mem.add("UTENTE" if m["role"] == "user" else "AI", m["content"])
+        mem.compact(model_name, summarizer)
+        return mem
+
+    def __bool__(self):
+        return bool(self.turns or self.summary)
+
+    def add(self, role, text):
+        self.turns.append((role, text or ""))
+
+    def clear(self):
+        self.turns, self.summary, self.n_folded = [], "", 0
+
+    @staticmethod
+    def _fmt(turn):
+        return f"{turn[0]}: {turn[1]}"
+
+    def _budgets(self, model_name):
+        total = get_context_budget(model_name)
+        summary_budget = int(total * config.CHAT_SUMMARY_RATIO)
+        return total, summary_budget, total - summary_budget
+
+    def compact(self, model_name, summarizer=None):
+        """
+        Riassume i turni più vecchi se i turni alla lettera superano il budget.
+        Con isteresi: si piega fino a CHAT_COMPACT_TARGET del budget, così il riassunto
+        (una chiamata al modello) scatta una volta ogni diversi turni e non a ogni turno.
+        summarizer(riassunto_precedente, testo_turni, max_token) -> nuovo riassunto.
+        """
+        _, summary_budget, recent_budget = self._budgets(model_name)
+        recent_tokens = sum(stima_token(self._fmt(t)) for t in self.turns)
+        if recent_tokens <= recent_budget: return False
+        target = int(recent_budget * config.CHAT_COMPACT_TARGET)
+
+        # Pieghiamo dal più vecchio fino alla soglia bassa (o resta il minimo garantito)
+        fold = []
+        while self.turns and recent_tokens > target:
+            if len(self.turns) <= config.CHAT_MIN_RECENT_TURNS and fold: break
+            t = self.turns.pop(0)
+            recent_tokens -= stima_token(self._fmt(t))
+            fold.append(t)
+        if not fold: return False
+
+        turns_text = "\n".join(self._fmt(t) for t in fold)
+        new_summary = None
+        if summarizer:
+            try: new_summary = summarizer(self.summary, turns_text, summary_budget)
+            except Exception as e: print(f"Errore riassunto chat: {e}")
+        if not new_summary:
+            new_summary = _riassunto_estrattivo(self.summary, turns_text, summary_budget)
+
+        self.summary = _riassunto_estrattivo("", new_summary, summary_budget)
+        self.n_folded += len(fold)
+        return True
+
+    def render(self, model_name):
+        """Testo di contesto da inviare al modello, entro il budget"""
+        total, summary_budget, _ = self._budgets(model_name)
+        blocks = []
+        used = 0
+        if self.summary:
+            summary_txt = _riassunto_estrattivo("", self.summary, summary_budget)
+            blocks.append(f"RIASSUNTO CONVERSAZIONE PRECEDENTE ({self.n_folded} turni):\n{summary_txt}\n---")
+            used = stima_token(blocks[0])
+
+        # Dal più recente all'indietro finché c'è spazio
+        recent = []
+        for t in reversed(self.turns):
+            line = self._fmt(t)
+            cost = stima_token(line)
+            if used + cost > total:
+                room = (total - used) * 4
+                if room > 200 and not recent: recent.append("..." + line[-room:])
+                break
+            recent.append(line)
+            used += cost
+        blocks.extend(reversed(recent))
+        return "\n".join(blocks)
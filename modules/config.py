@@ -102,3 +102,121 @@ DOCS_METADATA = {
     "Diffida_Adempiere": "Diffida ad Adempiere",
     "Trascrizione_Chat": "Cronologia Completa"
 }
+
+# Concorrenza Generazione Batch (Tab 3)
+# Numero massimo di richieste parallele verso Gemini per modello.
+# I modelli Pro hanno quote RPM più basse: teniamo il limite più stretto.
+AI_CONCURRENCY_DEFAULT = 4
+AI_CONCURRENCY_LIMITS = {
+    "gemini-1.5-flash": 6,
+    "gemini-2.0-flash-exp": 6,
+    "gemini-1.5-pro": 2
+}
+
+# Pool Connessioni GenAI (client condiviso tra le sessioni)
+GENAI_POOL_SIZE = 20            # connessioni HTTP massime verso Gemini
+GENAI_POOL_KEEPALIVE = 10       # connessioni tenute calde in keep-alive
+GENAI_POOL_KEEPALIVE_EXPIRY = 120.0  # secondi prima di chiudere una connessione inattiva
+
+# Memoria Chat (compattazione contesto)
+# Budget di token (stimati ~4 caratteri/token) per il contesto inviato al modello.
+CHAT_CONTEXT_BUDGET_DEFAULT = 8000
+CHAT_CONTEXT_BUDGETS = {
+    "gemini-1.5-flash": 8000,
+    "gemini-2.0-flash-exp": 8000,
+    "gemini-1.5-pro": 16000
+}
+CHAT_SUMMARY_RATIO = 0.25       # quota del budget riservata al riassunto
+CHAT_MIN_RECENT_TURNS = 4       # turni recenti sempre tenuti alla lettera (se entrano nel budget)
+CHAT_COMPACT_TARGET = 0.5       # superato il budget, i recenti scendono a questa quota (isteresi)
+
+# Cronologia Chat Persistente (per fascicolo)
+CHAT_HISTORY_PAGE = 20          # messaggi letti dal DB all'apertura e per ogni "precedenti"
+CHAT_VISIBLE_MESSAGES = 20      # messaggi disegnati a schermo (gli altri restano compressi)
+
+# Cache Risposte Gemini
+AI_CACHE_ENABLED = True
+AI_CACHE_BACKEND = "memory"     # "memory" (LRU in processo) oppure "sqlite" (su disco)
+AI_CACHE_TTL_SECONDS = 24 * 3600
+AI_CACHE_MAX_ENTRIES = 500
+AI_CACHE_SQLITE_PATH = ".cache/ai_responses.sqlite"
+
+# Retrieval Documenti Caricati (indice lessicale BM25 locale)
+RAG_CHUNK_CHARS = 2000          # dimensione chunk in caratteri (~500 token)
+RAG_CHUNK_OVERLAP = 200
+RAG_TOP_K = 8
+RAG_TOKEN_BUDGET_CHAT = 4000    # token di estratti per ogni domanda in chat
+RAG_TOKEN_BUDGET_DOC = 6000     # token di estratti per ogni documento generato
+
+# Cache Estrazione Testo (chiave: SHA-256 del file + versione estrattore)
+EXTRACT_CACHE_MAX_ENTRIES = 64      # documenti tenuti in memoria (LRU)
+EXTRACT_CACHE_DIR = None            # es. ".cache/extract" per la copia su disco (testi dei clienti: opt-in)
+EXTRACT_CACHE_MAX_MB = 500          # tetto della copia su disco (LRU)
+
+# Estrazione PDF Parallela (pool di processi per file, pagine a blocchi)
+PDF_EXTRACT_WORKERS = 4         # processi massimi (limitati anche dai core disponibili)
+PDF_PARALLEL_MIN_PAGES = 40     # sotto questa soglia si estrae nel thread corrente
+PDF_PAGES_PER_SHARD = 25
+PDF_EXTRACT_TIMEOUT = 300       # secondi massimi per singolo file
+
+# Estrazione in Streaming (limite memoria per sessione)
+EXTRACT_SESSION_MEMORY_MB = 32      # oltre questa soglia il testo estratto va su file temporaneo
+EXTRACT_CACHE_MAX_TEXT_MB = 8       # testi più grandi non entrano nella cache in memoria (solo disco)
+
+# Archivio Testi Estratti per Fascicolo
+FASCICOLO_TEXT_DIR = ".data/testi_fascicoli"   # copia locale (gzip JSONL)
+FASCICOLO_TEXT_BUCKET = None                   # es. "testi-fascicoli" per usare Supabase Storage
+
+# Rendering DOCX e ZIP finale
+MP_START_METHOD = "forkserver"  # avvio dei processi worker (PDF, rendering): mai "fork" nel server multithread
+RENDER_WORKERS = 4              # processi per il rendering parallelo dei .docx
+RENDER_PARALLEL_MIN_DOCS = 3    # sotto questa soglia si renderizza nel thread corrente
+ZIP_SPOOL_MAX_MB = 1            # oltre questa dimensione lo ZIP vive su file temporaneo
+
+# Cache Rendering DOCX (chiave: titolo + contenuto + versione renderer)
+RENDER_CACHE_DIR = ".cache/render"  # None per disattivare
+RENDER_CACHE_MAX_MB = 200
+
+# Template Word dello Studio (carta intestata / stili)
+# File cercati: <DOCX_TEMPLATES_DIR>/<nome_studio_normalizzato>.docx, poi default.docx
+DOCX_TEMPLATES_DIR = "templates"
+
+# Cache Dati di Riferimento (listino, modelli, tipi causa)
+REF_CACHE_TTL_SECONDS = 600
+
+# Dashboard Fascicoli (lista paginata, solo colonne della card)
+DASHBOARD_PAGE_SIZE = 25
+
+# Scrittura Differita Campi Fascicolo (write-behind)
+WRITE_BUFFER_FLUSH_SECONDS = 2.0                  # intervallo di scarico in background
+WRITE_BUFFER_JOURNAL = ".data/fascicoli_pending.jsonl"  # journal locale (None per disattivare)
+
+# Backend Database
+# "supabase" = solo hosted (produzione), "sqlite" = solo locale,
+# "auto" = solo sviluppo: locale se mancano i secrets Supabase o il client non si crea (nessun test di rete)
+DB_BACKEND = "supabase"
+LOCAL_DB_PATH = ".data/lexvantage.sqlite"   # SQLite in modalità WAL
+# Nessun account creato di default: per un admin locale, in secrets [local_db] admin_email / admin_password
+LOCAL_DB_SEED_MODELS = [                    # caricati solo a database locale vuoto
+    {"model_name": "models/gemini-1.5-flash", "display_name": "Gemini 1.5 Flash (Veloce & Economico)", "is_active": True, "price_multiplier": 1.0},
+    {"model_name": "models/gemini-1.5-pro", "display_name": "Gemini 1.5 Pro (Avanzato & Costoso)", "is_active": True, "price_multiplier": 10.0}
+]
+
+# Telemetria Accessi Dati (per rerun)
+TELEMETRY_ENABLED = True
+TELEMETRY_LOG = None                      # es. ".data/telemetry.jsonl": una riga JSON per rerun (opt-in)
+TELEMETRY_LOG_MAX_MB = 10                 # rotazione per dimensione del log
+TELEMETRY_LOG_BACKUPS = 3                 # file ruotati conservati (.1, .2, ...)
+TELEMETRY_METRICS_PORT = None             # es. 9464 per esporre /metrics (OpenMetrics) su 127.0.0.1
+TELEMETRY_PANEL = False                   # pannello diagnostica in sidebar anche per i non admin
+
+# Outbox Email (invio SMTP in background)
+OUTBOX_DB_PATH = ".data/outbox.sqlite"  # coda durevole
+OUTBOX_BATCH_SIZE = 20                 # messaggi per giro sulla stessa sessione SMTP
+OUTBOX_MAX_ATTEMPTS = 6
+OUTBOX_BACKOFF_BASE = 5.0              # secondi, raddoppia a ogni tentativo
+OUTBOX_BACKOFF_MAX = 900.0
+OUTBOX_POLL_SECONDS = 5.0              # controllo dei retry programmati
+OUTBOX_KEEPALIVE_SECONDS = 60.0        # sessione SMTP chiusa dopo questa inattività
+OUTBOX_SMTP_TIMEOUT = 30
+OUTBOX_DEBUG_SMTP = None               # es. "127.0.0.1:1025" (python -m modules.outbox --debug-server 1025)
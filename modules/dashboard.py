@@ -1,11 +1,31 @@
 import streamlit as st
-from . import database, config
+from . import database, config, chat_memory
+
+def _chiudi_doc_store():
+    """Rilascia il testo estratto del fascicolo precedente (RAM o file temporaneo)"""
+    store = st.session_state.get("doc_store")
+    if store: store.close()
+    st.session_state.doc_store = None
+
+def _reset_lista():
+    """Forza la rilettura della prima pagina della lista fascicoli"""
+    st.session_state.dash_fascicoli = None
+    st.session_state.dash_cursore = None
+
+def _carica_pagina(supabase, user_id):
+    righe, cursore = database.get_fascicoli_utente(supabase, user_id, st.session_state.get("dash_cursore"))
+    st.session_state.dash_fascicoli = (st.session_state.get("dash_fascicoli") or []) + righe
+    st.session_state.dash_cursore = cursore
 
 def render_dashboard(supabase, user_id):
     st.markdown("## 📂 Dashboard Fascicoli")
     
-    # 1. Recupera Fascicoli
-    fascicoli = database.get_fascicoli_utente(supabase, user_id)
+    # 1. Recupera Fascicoli (prima pagina, una volta per sessione/utente)
+    if st.session_state.get("dash_fascicoli") is None or st.session_state.get("dash_uid") != user_id:
+        _reset_lista()
+        st.session_state.dash_uid = user_id
+        _carica_pagina(supabase, user_id)
+    fascicoli = st.session_state.dash_fascicoli
     
     # 2. BOX CREAZIONE NUOVO
     with st.expander("➕ CREA NUOVO FASCICOLO", expanded=not fascicoli):
@@ -33,10 +53,17 @@ def render_dashboard(supabase, user_id):
                     if new_f:
                         st.success(f"Fascicolo '{nome}' creato!")
                         st.session_state.current_fascicolo = new_f
+                        _reset_lista()
                         # Reset stato chat per il nuovo caso
                         st.session_state.messages = []
-                        st.session_state.contesto_chat = ""
+                        st.session_state.chat_has_more = False
+                        st.session_state.chat_visibili = config.CHAT_VISIBLE_MESSAGES
+                        st.session_state.chat_memory = chat_memory.ChatMemory()
+                        _chiudi_doc_store()
+                        st.session_state.doc_index = None
+                        st.session_state.doc_index_sig = None
                         st.session_state.dati_calc = "Nessun calcolo effettuato."
+                        if st.session_state.get("generated_docs_zip"): st.session_state.generated_docs_zip.close()
                         st.session_state.generated_docs_zip = None
                         st.rerun()
                 else:
@@ -65,16 +92,36 @@ def render_dashboard(supabase, user_id):
             with col_act:
                 # Bottone APRI
                 if st.button("APRI", key=f"open_{f['id']}", type="primary", use_container_width=True):
+                    # Riga completa solo ora (la lista ha solo le colonne della card)
+                    f = database.get_fascicolo(supabase, f['id'])
+                    if not f:
+                        st.error("Fascicolo non trovato.")
+                        _reset_lista()
+                        st.stop()
                     st.session_state.current_fascicolo = f
                     # Caricamento Stato
                     st.session_state.dati_calc = f.get('dati_tecnici') or "Nessun calcolo."
-                    # NB: Qui in futuro caricheremo la chat history dal DB
-                    st.session_state.messages = [] 
+                    # Chat History: solo l'ultima finestra, le pagine precedenti su richiesta
+                    msgs, altri = database.carica_messaggi(supabase, f['id'], limit=config.CHAT_HISTORY_PAGE)
+                    st.session_state.messages = msgs
+                    st.session_state.chat_has_more = altri
+                    st.session_state.chat_visibili = config.CHAT_VISIBLE_MESSAGES
+                    st.session_state.chat_memory = chat_memory.ChatMemory.from_messages(msgs)
+                    _chiudi_doc_store()
+                    st.session_state.doc_index = None
+                    st.session_state.doc_index_sig = None
                     st.rerun()
                     
                 # Bottone ELIMINA
                 if st.button("Elimina", key=f"del_{f['id']}", use_container_width=True):
                     database.elimina_fascicolo(supabase, f['id'])
+                    st.session_state.dash_fascicoli = [x for x in fascicoli if x['id'] != f['id']]
                     st.toast("Fascicolo eliminato")
                     st.rerun()
         st.markdown("---")
+
+    # 4. CARICA ALTRI (pagina successiva, su richiesta)
+    if st.session_state.dash_cursore:
+        if st.button("Carica altri fascicoli", use_container_width=True):
+            _carica_pagina(supabase, user_id)
+            st.rerun()
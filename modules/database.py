@@ -1,6 +1,11 @@
 import streamlit as st
 import json
+import os
+import copy
+import time
+import threading
 from datetime import datetime
+from . import config, doc_renderer, local_db, telemetry
 
 try:
     from supabase import create_client
@@ -10,59 +15,167 @@ except ImportError:
 
 @st.cache_resource
 def init_supabase():
-    if not SUPABASE_AVAILABLE: return None
+    """
+    Client del database: Supabase hosted oppure il backend SQLite locale (stessa interfaccia),
+    secondo config.DB_BACKEND.
+    """
+    if config.DB_BACKEND == "sqlite": return telemetry.strumenta_client(init_local_db())
+    client = None
+    if SUPABASE_AVAILABLE:
+        try:
+            client = create_client(st.secrets["supabase"]["url"], st.secrets["supabase"]["key"])
+        except: client = None
+    if client is None and config.DB_BACKEND == "auto":
+        print(f"ATTENZIONE: Supabase non configurato, uso il database locale {config.LOCAL_DB_PATH} (solo sviluppo)")
+        client = init_local_db()
+    return telemetry.strumenta_client(client)
+
+def init_local_db(path=None):
+    """Backend SQLite (WAL) con le funzioni server-side registrate come RPC locali"""
+    rpc = {
+        "append_generazione": lambda conn, p: append_generazione_sqlite(
+            conn, p["p_fascicolo_id"], p["p_docs"], p["p_costo_delta"]
+        )
+    }
+    admin = None
     try:
-        return create_client(st.secrets["supabase"]["url"], st.secrets["supabase"]["key"])
-    except: return None
+        s = st.secrets["local_db"]
+        if s.get("admin_email") and s.get("admin_password"): admin = (s["admin_email"], s["admin_password"])
+    except Exception: pass
+    return local_db.LocalClient(path or config.LOCAL_DB_PATH, rpc=rpc, admin=admin)
+
+# --- CACHE DATI DI RIFERIMENTO ---
+class RefDataCache:
+    """
+    Cache TTL condivisa dal processo per le tabelle di catalogo
+    (listino_prezzi, gemini_models, config_tipi_causa).
+    Chiave = (tabella, variante). Gli errori di lettura non vengono messi in cache.
+    invalidate(tabella) va chiamata dopo ogni scrittura su quella tabella.
+    """
+    def __init__(self, ttl_seconds):
+        self.ttl = ttl_seconds
+        self._lock = threading.Lock()
+        self._data = {}
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get_or_load(self, table, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get((table, key))
+            if item and now - item[0] < self.ttl:
+                self._stats["hits"] += 1
+                return copy.deepcopy(item[1])
+            self._stats["misses"] += 1
+        value = loader()  # eccezioni propagate: niente cache
+        with self._lock:
+            self._data[(table, key)] = (time.monotonic(), value)
+        return copy.deepcopy(value)
+
+    def invalidate(self, table=None):
+        with self._lock:
+            if table is None: self._data.clear()
+            else:
+                for k in [k for k in self._data if k[0] == table]: del self._data[k]
+            self._stats["invalidations"] += 1
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._stats)
+            out["entries"] = len(self._data)
+        tot = out["hits"] + out["misses"]
+        out["hit_rate"] = round(out["hits"] / tot, 3) if tot else 0.0
+        return out
+
+@st.cache_resource
+def get_ref_cache():
+    return RefDataCache(config.REF_CACHE_TTL_SECONDS)
+
+def invalida_cache_riferimento(table=None):
+    """Da chiamare dopo le modifiche a listino/modelli/tipi causa (None = tutto)"""
+    get_ref_cache().invalidate(table)
 
 # --- CONFIGURAZIONI ---
 def get_config_tipi_causa(supabase):
     if not supabase: return None
     try:
-        res = supabase.table("config_tipi_causa").select("*").execute()
-        return res.data
+        return get_ref_cache().get_or_load(
+            "config_tipi_causa", "*",
+            lambda: supabase.table("config_tipi_causa").select("*").execute().data
+        )
     except: return None
 
 def get_pricing(supabase):
-    if not supabase: return None
-    try:
-        res = supabase.table("listino_prezzi").select("*").eq("tipo_documento", "pacchetto_base").execute()
-        return res.data[0] if res.data else None
-    except: return None
+    # Stessa tabella del listino completo: nessuna query in più
+    return get_listino_completo(supabase).get("pacchetto_base")
 
-def get_active_gemini_models(supabase):
-    """
-    Recupera i modelli attivi dalla tabella 'gemini_models'.
-    """
+def get_gemini_models_all(supabase):
+    """Tutti i modelli (anche non attivi), per moltiplicatori e selezione"""
     if not supabase: return []
     try:
-        res = supabase.table("gemini_models").select("*").eq("is_active", True).execute()
-        return res.data
+        return get_ref_cache().get_or_load(
+            "gemini_models", "*",
+            lambda: supabase.table("gemini_models").select("*").execute().data
+        )
     except Exception:
         # Fallback sicuro se la tabella non esiste
         return []
 
+def get_active_gemini_models(supabase):
+    """
+    Recupera i modelli attivi dalla tabella 'gemini_models'.
+    """
+    return [m for m in get_gemini_models_all(supabase) if m.get("is_active")]
+
 def get_listino_completo(supabase):
     """
     Recupera TUTTO il listino prezzi come dizionario.
     """
     if not supabase: return {}
-    try:
+    def _load():
         res = supabase.table("listino_prezzi").select("*").execute()
         pricing_dict = {}
         for row in res.data:
             pricing_dict[row['tipo_documento']] = row
         return pricing_dict
+    try:
+        return get_ref_cache().get_or_load("listino_prezzi", "*", _load)
     except Exception as e:
         print(f"Err listino: {e}")
         return {}
 
 # --- GESTIONE FASCICOLI (CRUD) ---
-def get_fascicoli_utente(supabase, user_id):
-    """Recupera lista fascicoli per la dashboard"""
-    if not supabase: return []
-    res = supabase.table("fascicoli").select("*").eq("user_id", user_id).order("created_at", desc=True).execute()
-    return res.data
+# Colonne mostrate nelle card della dashboard: niente blob (dati_tecnici, documenti, testi)
+FASCICOLO_CARD_COLUMNS = "id, nome_riferimento, nome_cliente, tipo_causa, livello_aggressivita, created_at"
+
+def get_fascicoli_utente(supabase, user_id, cursore=None, limit=None):
+    """
+    Pagina della lista fascicoli per la dashboard (solo colonne card).
+    Paginazione keyset su (created_at, id) decrescenti: il costo per pagina non dipende
+    da quanti fascicoli ha lo studio. Ritorna (righe, cursore_successivo | None).
+    """
+    if not supabase: return [], None
+    limit = limit or config.DASHBOARD_PAGE_SIZE
+    q = supabase.table("fascicoli").select(FASCICOLO_CARD_COLUMNS).eq("user_id", user_id)
+    if cursore:
+        c_ts, c_id = cursore
+        q = q.or_(f'created_at.lt."{c_ts}",and(created_at.eq."{c_ts}",id.lt.{c_id})')
+    # Una riga in più per sapere se esiste la pagina successiva
+    res = q.order("created_at", desc=True).order("id", desc=True).limit(limit + 1).execute()
+    righe = res.data or []
+    if len(righe) <= limit:
+        return righe, None
+    righe = righe[:limit]
+    return righe, (righe[-1]["created_at"], righe[-1]["id"])
+
+def get_fascicolo(supabase, fascicolo_id):
+    """Riga completa del fascicolo, letta solo all'apertura"""
+    if not supabase: return None
+    res = supabase.table("fascicoli").select("*").eq("id", fascicolo_id).execute()
+    if not res.data: return None
+    # Le scritture differite non ancora scaricate valgono già in lettura
+    row = res.data[0]
+    row.update(get_write_buffer().pending(fascicolo_id))
+    return row
 
 def crea_fascicolo(supabase, user_id, nome, tipo, cliente, controparte):
     """Crea un nuovo fascicolo con metadati base"""
@@ -86,108 +199,531 @@ def aggiorna_fascicolo(supabase, fascicolo_id, update_data):
     if not supabase: return
     supabase.table("fascicoli").update(update_data).eq("id", fascicolo_id).execute()
 
+# --- SCRITTURA DIFFERITA (write-behind) DEI CAMPI FASCICOLO ---
+class FascicoloWriteBuffer:
+    """
+    Buffer write-behind condiviso dal processo per gli aggiornamenti di campo dei fascicoli
+    (slider aggressività, dati tecnici...).
+    - put() fonde i campi per fascicolo (vince l'ultimo valore) e li annota nel journal locale.
+    - Un thread di sfondo scarica il buffer ogni `interval` secondi: un UPDATE per fascicolo.
+    - flush() sincrono per navigazione e logout. Al riavvio il journal viene riapplicato.
+    """
+    def __init__(self, journal_path, interval):
+        self.journal_path = journal_path
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()   # un flush alla volta: gli UPDATE restano in ordine
+        self._pending = {}
+        self._client = None
+        self._stats = {"puts": 0, "writes": 0, "errors": 0, "replayed": 0}
+        self._load_journal()
+        self._thread = threading.Thread(target=self._run, name="fascicoli-write-behind", daemon=True)
+        self._thread.start()
+
+    def _load_journal(self):
+        if not self.journal_path or not os.path.exists(self.journal_path): return
+        with open(self.journal_path, encoding="utf-8") as fh:
+            for line in fh:
+                try: rec = json.loads(line)
+                except ValueError: continue  # riga troncata da un crash
+                self._pending.setdefault(rec["id"], {}).update(rec["fields"])
+        self._stats["replayed"] = len(self._pending)
+
+    def _journal_append(self, fascicolo_id, fields):
+        if not self.journal_path: return
+        os.makedirs(os.path.dirname(self.journal_path) or ".", exist_ok=True)
+        with open(self.journal_path, "a", encoding="utf-8") as fh:
+            fh.write(json.dumps({"id": fascicolo_id, "fields": fields}, default=str) + "\n")
+
+    def _journal_rewrite(self):
+        """Compatta il journal allo stato pendente (da chiamare con self._lock)"""
+        if not self.journal_path: return
+        if not self._pending:
+            if os.path.exists(self.journal_path): os.remove(self.journal_path)
+            return
+        tmp = self.journal_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            for fid, fields in self._pending.items():
+                fh.write(json.dumps({"id": fid, "fields": fields}, default=str) + "\n")
+        os.replace(tmp, self.journal_path)
+
+    def attach(self, client):
+        if client is not None: self._client = client
+
+    def put(self, client, fascicolo_id, fields):
+        with self._lock:
+            self.attach(client)
+            self._pending.setdefault(fascicolo_id, {}).update(fields)
+            try: self._journal_append(fascicolo_id, fields)
+            except OSError as e: print(f"Errore journal scritture: {e}")
+            self._stats["puts"] += 1
+
+    def pending(self, fascicolo_id):
+        with self._lock:
+            return dict(self._pending.get(fascicolo_id, {}))
+
+    def discard(self, fascicolo_id):
+        with self._lock:
+            if self._pending.pop(fascicolo_id, None) is not None:
+                self._journal_rewrite()
+
+    def flush(self, fascicolo_id=None):
+        """Scrive i campi pendenti (di un fascicolo o di tutti). Ritorna il numero di UPDATE riusciti."""
+        with self._flush_lock:
+            with self._lock:
+                client = self._client
+                if client is None: return 0
+                ids = [fascicolo_id] if fascicolo_id is not None else list(self._pending)
+                batch = {i: self._pending.pop(i) for i in ids if i in self._pending}
+            if not batch: return 0
+
+            failed = {}
+            for fid, fields in batch.items():
+                try:
+                    client.table("fascicoli").update(fields).eq("id", fid).execute()
+                except Exception as e:
+                    print(f"Errore scrittura differita fascicolo {fid}: {e}")
+                    failed[fid] = fields
+
+            with self._lock:
+                # I falliti tornano in coda, sotto eventuali valori più recenti
+                for fid, fields in failed.items():
+                    merged = dict(fields)
+                    merged.update(self._pending.get(fid, {}))
+                    self._pending[fid] = merged
+                self._stats["writes"] += len(batch) - len(failed)
+                self._stats["errors"] += len(failed)
+                try: self._journal_rewrite()
+                except OSError as e: print(f"Errore journal scritture: {e}")
+            return len(batch) - len(failed)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try: self.flush()
+            except Exception as e: print(f"Errore flush differito: {e}")
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._stats)
+            out["pending_fascicoli"] = len(self._pending)
+        return out
+
+@st.cache_resource
+def get_write_buffer():
+    buf = FascicoloWriteBuffer(config.WRITE_BUFFER_JOURNAL, config.WRITE_BUFFER_FLUSH_SECONDS)
+    # Client subito agganciato: le voci riapplicate dal journal partono al primo giro del thread
+    buf.attach(init_supabase())
+    return buf
+
+def aggiorna_fascicolo_differito(supabase, fascicolo_id, update_data):
+    """Come aggiorna_fascicolo, ma non blocca: i campi vengono fusi e scritti in background"""
+    if not supabase: return
+    get_write_buffer().put(supabase, fascicolo_id, update_data)
+
+def flush_fascicoli(supabase=None, fascicolo_id=None):
+    """Scrittura immediata dei campi pendenti (uscita dal fascicolo, logout)"""
+    buf = get_write_buffer()
+    buf.attach(supabase)
+    return buf.flush(fascicolo_id)
+
 def elimina_fascicolo(supabase, fascicolo_id):
     if not supabase: return
     supabase.table("fascicoli").delete().eq("id", fascicolo_id).execute()
+    get_write_buffer().discard(fascicolo_id)
+    elimina_testi_fascicolo(supabase, fascicolo_id)
+
+# --- ARCHIVIO TESTI ESTRATTI (per fascicolo) ---
+# Il testo estratto dai documenti caricati viene salvato compresso (gzip JSONL) in
+# config.FASCICOLO_TEXT_DIR e, se configurato, nel bucket Supabase Storage.
+# Il collegamento sta nella colonna jsonb 'testi_estratti' di 'fascicoli':
+#   ALTER TABLE fascicoli ADD COLUMN testi_estratti jsonb;
+
+def _path_testi_locale(fascicolo_id):
+    return os.path.join(config.FASCICOLO_TEXT_DIR, f"{fascicolo_id}.jsonl.gz")
+
+@telemetry.traccia("storage")
+def salva_testi_fascicolo(supabase, fascicolo_id, store):
+    """Persiste lo store del testo estratto e aggiorna il link sul fascicolo. Restituisce i metadati."""
+    if not store: return None
+    path = _path_testi_locale(fascicolo_id)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as fh:
+            store.dump(fh)
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"Errore salvataggio testi fascicolo: {e}")
+        return None
+
+    meta = {
+        "file": store.file_names(),
+        "bytes": store.size_bytes,
+        "storage": "locale",
+        "percorso": os.path.basename(path),
+        "aggiornato": datetime.now().strftime("%Y-%m-%d %H:%M")
+    }
+    if supabase and config.FASCICOLO_TEXT_BUCKET:
+        try:
+            with open(path, "rb") as fh:
+                supabase.storage.from_(config.FASCICOLO_TEXT_BUCKET).upload(
+                    meta["percorso"], fh.read(), {"content-type": "application/gzip", "upsert": "true"}
+                )
+            meta["storage"] = "bucket"
+        except Exception as e:
+            print(f"Errore upload bucket testi: {e}")
+
+    try:
+        aggiorna_fascicolo(supabase, fascicolo_id, {"testi_estratti": meta})
+    except Exception as e:
+        print(f"Errore link testi fascicolo: {e}")
+    return meta
+
+@telemetry.traccia("storage")
+def carica_testi_fascicolo(supabase, fascicolo):
+    """
+    Ricarica lo store del testo estratto di un fascicolo (None se non archiviato).
+    Prima la copia locale, poi il bucket (che viene anche salvato in locale).
+    """
+    meta = (fascicolo or {}).get("testi_estratti")
+    if not meta: return None
+    path = _path_testi_locale(fascicolo["id"])
+    try:
+        if not os.path.exists(path) and meta.get("storage") == "bucket" and supabase and config.FASCICOLO_TEXT_BUCKET:
+            data = supabase.storage.from_(config.FASCICOLO_TEXT_BUCKET).download(meta["percorso"])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as fh:
+                fh.write(data)
+        if not os.path.exists(path): return None
+        with open(path, "rb") as fh:
+            return doc_renderer.ExtractedTextStore.load(fh)
+    except Exception as e:
+        print(f"Errore caricamento testi fascicolo: {e}")
+        return None
+
+def elimina_testi_fascicolo(supabase, fascicolo_id):
+    path = _path_testi_locale(fascicolo_id)
+    try:
+        if os.path.exists(path): os.remove(path)
+        if supabase and config.FASCICOLO_TEXT_BUCKET:
+            supabase.storage.from_(config.FASCICOLO_TEXT_BUCKET).remove([os.path.basename(path)])
+    except Exception as e:
+        print(f"Errore eliminazione testi fascicolo: {e}")
 
 # --- LOGICA TRANSAZIONALE E STORICO ---
 
+# --- DOCUMENTI GENERATI (tabella append-only) ---
+# Un documento = una riga. Il contenuto si legge solo quando serve (download).
+#   CREATE TABLE documenti_fascicolo (
+#       id bigint GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+#       fascicolo_id uuid NOT NULL REFERENCES fascicoli(id) ON DELETE CASCADE,
+#       titolo text NOT NULL,
+#       tipo text NOT NULL DEFAULT 'auto_generato',
+#       contenuto text,
+#       data_creazione text,
+#       metadata_pricing jsonb,
+#       legacy_pos integer,
+#       created_at timestamptz NOT NULL DEFAULT now()
+#   );
+#   CREATE INDEX documenti_fascicolo_fid ON documenti_fascicolo(fascicolo_id, created_at);
+#   CREATE UNIQUE INDEX documenti_fascicolo_legacy ON documenti_fascicolo(fascicolo_id, legacy_pos);
+# La vecchia colonna fascicoli.documenti_generati viene svuotata da migra_documenti_generati.
+# legacy_pos = posizione nell'array legacy (NULL per i documenti nuovi): rende la migrazione ripetibile.
+
+DOC_META_COLUMNS = "id, fascicolo_id, titolo, tipo, data_creazione, metadata_pricing, created_at"
+
+def _riga_documento(fascicolo_id, doc):
+    return {
+        "fascicolo_id": fascicolo_id,
+        "titolo": doc.get("titolo", "Documento"),
+        "tipo": doc.get("tipo", "auto_generato"),
+        "contenuto": doc.get("contenuto", ""),
+        "data_creazione": doc.get("data_creazione") or datetime.now().strftime("%Y-%m-%d %H:%M"),
+        "metadata_pricing": doc.get("metadata_pricing")
+    }
+
+def inserisci_documenti(supabase, fascicolo_id, docs):
+    """Append di una lista di documenti (snapshot) con un solo INSERT multiplo"""
+    if not supabase or not docs: return []
+    rows = [_riga_documento(fascicolo_id, d) for d in docs]
+    res = supabase.table("documenti_fascicolo").insert(rows).execute()
+    return res.data or []
+
+# Append atomico documenti + incremento costo, in un solo round-trip (RPC Postgres).
+# Due generazioni concorrenti sullo stesso fascicolo non si sovrascrivono più.
+#   CREATE OR REPLACE FUNCTION append_generazione(p_fascicolo_id uuid, p_docs jsonb, p_costo_delta numeric)
+#   RETURNS numeric LANGUAGE sql AS $$
+#       INSERT INTO documenti_fascicolo (fascicolo_id, titolo, tipo, contenuto, data_creazione, metadata_pricing)
+#       SELECT p_fascicolo_id, d.titolo, d.tipo, d.contenuto, d.data_creazione, d.metadata_pricing
+#       FROM jsonb_to_recordset(p_docs)
+#            AS d(titolo text, tipo text, contenuto text, data_creazione text, metadata_pricing jsonb);
+#       UPDATE fascicoli SET costo_stimato = COALESCE(costo_stimato, 0) + p_costo_delta
+#       WHERE id = p_fascicolo_id
+#       RETURNING costo_stimato;
+#   $$;
+
+def append_generazione_sqlite(conn, fascicolo_id, docs, costo_delta):
+    """Stand-in SQLite di append_generazione (test locali): stessa semantica, una transazione"""
+    rows = [_riga_documento(fascicolo_id, d) for d in docs]
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "INSERT INTO documenti_fascicolo (fascicolo_id, titolo, tipo, contenuto, data_creazione, metadata_pricing) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(r["fascicolo_id"], r["titolo"], r["tipo"], r["contenuto"], r["data_creazione"],
+              json.dumps(r["metadata_pricing"]) if r["metadata_pricing"] is not None else None) for r in rows]
+        )
+        conn.execute(
+            "UPDATE fascicoli SET costo_stimato = COALESCE(costo_stimato, 0) + ? WHERE id = ?",
+            (float(costo_delta), fascicolo_id)
+        )
+        row = conn.execute("SELECT costo_stimato FROM fascicoli WHERE id = ?", (fascicolo_id,)).fetchone()
+    return float(row[0]) if row else None
+
+def _rpc_mancante(e):
+    """True solo se la funzione non esiste sul server (PostgREST PGRST202 / HTTP 404)"""
+    code = str(getattr(e, "code", "") or "")
+    return code in ("PGRST202", "404") or "PGRST202" in str(e)
+
+def append_generazione(supabase, fascicolo_id, docs, costo_delta):
+    """
+    Aggiunge i nuovi documenti e somma costo_delta al costo del fascicolo, atomicamente.
+    Ritorna il nuovo costo_stimato (None se non disponibile).
+    Gli errori diversi da "funzione mancante" vengono rilanciati: dopo un timeout la RPC
+    può aver già fatto commit, e ripetere insert + update duplicherebbe documenti e costo.
+    """
+    if not supabase: return None
+    rows = [_riga_documento(fascicolo_id, d) for d in docs]
+    try:
+        res = supabase.rpc("append_generazione", {
+            "p_fascicolo_id": fascicolo_id, "p_docs": rows, "p_costo_delta": float(costo_delta)
+        }).execute()
+    except Exception as e:
+        if not _rpc_mancante(e): raise
+        # Funzione non ancora installata: ripiego non atomico, ma nessun documento perso
+        print(f"RPC append_generazione non installata (ripiego su insert + update): {e}")
+        inserisci_documenti(supabase, fascicolo_id, docs)
+        res = supabase.table("fascicoli").select("costo_stimato").eq("id", fascicolo_id).execute()
+        nuovo = float((res.data[0].get("costo_stimato") if res.data else 0) or 0.0) + float(costo_delta)
+        supabase.table("fascicoli").update({"costo_stimato": nuovo}).eq("id", fascicolo_id).execute()
+        return nuovo
+    return float(res.data) if res.data is not None else None
+
+def lista_documenti(supabase, fascicolo_id):
+    """Solo metadati (niente contenuto), dal più vecchio al più recente"""
+    if not supabase: return []
+    try:
+        res = supabase.table("documenti_fascicolo").select(DOC_META_COLUMNS) \
+            .eq("fascicolo_id", fascicolo_id).order("created_at").execute()
+        return res.data or []
+    except Exception as e:
+        print(f"Errore lista documenti: {e}")
+        return []
+
+def get_contenuto_documento(supabase, doc_id):
+    """Contenuto completo di un documento, caricato on demand"""
+    if not supabase: return ""
+    res = supabase.table("documenti_fascicolo").select("contenuto").eq("id", doc_id).execute()
+    return res.data[0].get("contenuto", "") if res.data else ""
+
+def migra_documenti_generati(supabase, fascicolo_id=None):
+    """
+    Migrazione dallo storico JSON in fascicoli.documenti_generati alla tabella documenti_fascicolo.
+    fascicolo_id=None migra tutti i fascicoli. Idempotente: ogni riga è chiave (fascicolo_id, legacy_pos)
+    e l'upsert ignora quelle già copiate, quindi un'interruzione prima dello svuotamento dell'array
+    o due sessioni concorrenti non duplicano i documenti.
+    Restituisce il numero di documenti letti dallo storico legacy.
+    """
+    if not supabase: return 0
+    q = supabase.table("fascicoli").select("id, documenti_generati")
+    if fascicolo_id: q = q.eq("id", fascicolo_id)
+    migrati = 0
+    for row in q.execute().data or []:
+        legacy = row.get("documenti_generati")
+        if not isinstance(legacy, list) or not legacy: continue
+        rows = [dict(_riga_documento(row["id"], d), legacy_pos=i) for i, d in enumerate(legacy)]
+        supabase.table("documenti_fascicolo").upsert(
+            rows, on_conflict="fascicolo_id,legacy_pos", ignore_duplicates=True
+        ).execute()
+        supabase.table("fascicoli").update({"documenti_generati": []}).eq("id", row["id"]).execute()
+        migrati += len(legacy)
+    return migrati
+
 def archivia_generazione(supabase, fascicolo_id, nuovi_docs_dict):
     """
-    Legge lo storico esistente e aggiunge (append) i nuovi documenti.
+    Aggiunge (append) i nuovi documenti allo storico: una riga per documento.
     """
     if not supabase: return
     
     try:
-        # 1. Recupera storico attuale
-        res = supabase.table("fascicoli").select("documenti_generati").eq("id", fascicolo_id).execute()
-        if not res.data: return
-        
-        storico_attuale = res.data[0].get("documenti_generati", [])
-        
-        if not isinstance(storico_attuale, list):
-            storico_attuale = []
-            
-        # 2. Aggiungi timestamp
         timestamp_str = str(datetime.now().strftime("%Y-%m-%d %H:%M"))
-        
-        for titolo, doc_data in nuovi_docs_dict.items():
-            entry = {
-                "titolo": titolo,
-                "contenuto": doc_data.get("contenuto", ""),
-                "data_creazione": timestamp_str,
-                "tipo": "auto_generato" if "Chat" not in titolo else "trascrizione_chat"
-            }
-            storico_attuale.append(entry)
-            
-        # 3. Aggiorna DB
-        supabase.table("fascicoli").update({"documenti_generati": storico_attuale}).eq("id", fascicolo_id).execute()
+        docs = [{
+            "titolo": titolo,
+            "contenuto": doc_data.get("contenuto", ""),
+            "data_creazione": timestamp_str,
+            "tipo": "auto_generato" if "Chat" not in titolo else "trascrizione_chat"
+        } for titolo, doc_data in nuovi_docs_dict.items()]
+        inserisci_documenti(supabase, fascicolo_id, docs)
         
     except Exception as e:
         print(f"Errore archiviazione: {e}")
 
-def registra_transazione_doc(supabase, fascicolo_id, doc_type, model_name, tokens_in, tokens_out):
+# --- CRONOLOGIA CHAT (tabella append-only) ---
+# Un messaggio = una riga, inserita a ogni turno. Si carica solo la finestra più recente.
+#   CREATE TABLE messaggi_chat (
+#       id bigint GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+#       fascicolo_id uuid NOT NULL REFERENCES fascicoli(id) ON DELETE CASCADE,
+#       role text NOT NULL,
+#       content text NOT NULL,
+#       archiviato boolean NOT NULL DEFAULT false,
+#       created_at timestamptz NOT NULL DEFAULT now()
+#   );
+#   CREATE INDEX messaggi_chat_fid ON messaggi_chat(fascicolo_id, archiviato, id DESC);
+# 'archiviato' chiude la sessione di chat dopo la generazione (la trascrizione va nei documenti).
+
+def salva_messaggi(supabase, fascicolo_id, messaggi):
+    """Append dei messaggi di un turno (utente + AI) con un solo INSERT. Ritorna le righe con id."""
+    if not supabase or not messaggi: return []
+    rows = [{"fascicolo_id": fascicolo_id, "role": m["role"], "content": m["content"]} for m in messaggi]
+    try:
+        res = supabase.table("messaggi_chat").insert(rows).execute()
+        return res.data or []
+    except Exception as e:
+        print(f"Errore salvataggio chat: {e}")
+        return []
+
+def carica_messaggi(supabase, fascicolo_id, prima_di=None, limit=None):
+    """
+    Finestra dei messaggi della sessione aperta, dal più vecchio al più recente.
+    prima_di = id del messaggio più vecchio già caricato (per le pagine precedenti),
+    limit=None carica tutta la sessione. Ritorna (messaggi, ci_sono_precedenti).
+    """
+    if not supabase: return [], False
+    try:
+        q = supabase.table("messaggi_chat").select("id, role, content") \
+            .eq("fascicolo_id", fascicolo_id).eq("archiviato", False)
+        if prima_di: q = q.lt("id", prima_di)
+        q = q.order("id", desc=True)
+        if limit: q = q.limit(limit + 1)
+        righe = q.execute().data or []
+    except Exception as e:
+        print(f"Errore caricamento chat: {e}")
+        return [], False
+    altri = bool(limit) and len(righe) > limit
+    if altri: righe = righe[:limit]
+    return list(reversed(righe)), altri
+
+def archivia_messaggi(supabase, fascicolo_id):
+    """Chiude la sessione di chat corrente (i messaggi restano, ma non vengono più caricati)"""
+    if not supabase: return
+    try:
+        supabase.table("messaggi_chat").update({"archiviato": True}) \
+            .eq("fascicolo_id", fascicolo_id).eq("archiviato", False).execute()
+    except Exception as e:
+        print(f"Errore archiviazione chat: {e}")
+
+def get_moltiplicatore_modello(supabase, model_name):
+    """Moltiplicatore prezzo del modello (Es. Flash=1.0, Pro=10.0), dalla cache dati di riferimento"""
+    for m in get_gemini_models_all(supabase):
+        if m.get("model_name") == model_name:
+            try: return float(m.get('price_multiplier', 1.0))
+            except (TypeError, ValueError): break
+    return 1.0 # Fallback 1.0 se tabella o modello non trovati
+
+def _calcola_prezzo_doc(doc_type, model_name, model_multiplier, listino_row, tokens_in, tokens_out, cached=False):
+    """Formula "value based" + snapshot per storico (nessun accesso al DB)"""
+    cached_tokens = {"input": tokens_in, "output": tokens_out} if cached else None
+    if cached: tokens_in, tokens_out = 0, 0
+
+    # 1. Listino Base del Documento
+    prezzo_fisso = 0.0
+    costo_base_in = 0.0
+    costo_base_out = 0.0
+    
+    try:
+        if listino_row:
+            prezzo_fisso = float(listino_row.get('prezzo_fisso', 0.0))
+            costo_base_in = float(listino_row.get('prezzo_per_1k_input_token', 0.0))
+            costo_base_out = float(listino_row.get('prezzo_per_1k_output_token', 0.0))
+    except:
+        pass # Fallback a 0
+
+    # 2. Calcolo Parte Variabile (Valore Intellettuale)
+    valore_input = (tokens_in / 1000) * costo_base_in
+    valore_output = (tokens_out / 1000) * costo_base_out
+    
+    # 3. Applicazione Moltiplicatore Modello
+    variabile_totale = (valore_input + valore_output) * model_multiplier
+    
+    prezzo_finale = prezzo_fisso + variabile_totale
+    
+    # 4. Creazione Snapshot per storico
+    doc_snapshot = {
+        "titolo": doc_type,
+        "tipo": "auto_generato",
+        "data_creazione": datetime.now().strftime("%Y-%m-%d %H:%M"),
+        "metadata_pricing": {
+            "model_used": model_name,
+            "multiplier_used": model_multiplier,
+            "tokens": {"input": tokens_in, "output": tokens_out},
+            "cached": bool(cached),
+            "cached_tokens": cached_tokens,
+            "components": {
+                "fixed": prezzo_fisso,
+                "variable_base": valore_input + valore_output,
+                "variable_final": variabile_totale
+            },
+            "final_price": prezzo_finale
+        }
+    }
+    return prezzo_finale, doc_snapshot
+
+def registra_transazione_doc(supabase, fascicolo_id, doc_type, model_name, tokens_in, tokens_out, cached=False):
     """
     CALCOLO PREZZO "VALUE BASED":
     Prezzo = Fisso + [ (CostoIn * TokIn) + (CostoOut * TokOut) ] * MoltiplicatoreModello
+    Se cached=True la risposta viene dalla cache AI: nessun token fresco, si fattura solo il fisso.
     Restituisce: prezzo_finale (float), doc_snapshot (dict)
+    Per più documenti usare registra_transazioni_batch.
     """
     if not supabase: return 0.0, {}
 
     try:
-        # 1. Recupera Moltiplicatore Modello (Es. Flash=1.0, Pro=10.0)
-        model_multiplier = 1.0
-        try:
-            mod_res = supabase.table("gemini_models").select("price_multiplier").eq("model_name", model_name).execute()
-            if mod_res.data:
-                model_multiplier = float(mod_res.data[0].get('price_multiplier', 1.0))
-        except:
-            pass # Fallback 1.0 se tabella non trovata
-
-        # 2. Recupera Listino Base del Documento
-        prezzo_fisso = 0.0
-        costo_base_in = 0.0
-        costo_base_out = 0.0
-        
-        try:
-            list_res = supabase.table("listino_prezzi").select("*").eq("tipo_documento", doc_type).execute()
-            if list_res.data:
-                row = list_res.data[0]
-                prezzo_fisso = float(row.get('prezzo_fisso', 0.0))
-                costo_base_in = float(row.get('prezzo_per_1k_input_token', 0.0))
-                costo_base_out = float(row.get('prezzo_per_1k_output_token', 0.0))
-        except:
-            pass # Fallback a 0
-
-        # 3. Calcolo Parte Variabile (Valore Intellettuale)
-        valore_input = (tokens_in / 1000) * costo_base_in
-        valore_output = (tokens_out / 1000) * costo_base_out
-        
-        # 4. Applicazione Moltiplicatore Modello
-        variabile_totale = (valore_input + valore_output) * model_multiplier
-        
-        prezzo_finale = prezzo_fisso + variabile_totale
-        
-        # 5. Creazione Snapshot per storico
-        doc_snapshot = {
-            "titolo": doc_type,
-            "tipo": "auto_generato",
-            "data_creazione": datetime.now().strftime("%Y-%m-%d %H:%M"),
-            "metadata_pricing": {
-                "model_used": model_name,
-                "multiplier_used": model_multiplier,
-                "tokens": {"input": tokens_in, "output": tokens_out},
-                "components": {
-                    "fixed": prezzo_fisso,
-                    "variable_base": valore_input + valore_output,
-                    "variable_final": variabile_totale
-                },
-                "final_price": prezzo_finale
-            }
-        }
-
-        return prezzo_finale, doc_snapshot
+        model_multiplier = get_moltiplicatore_modello(supabase, model_name)
+        row = get_listino_completo(supabase).get(doc_type)
+        return _calcola_prezzo_doc(doc_type, model_name, model_multiplier, row, tokens_in, tokens_out, cached)
 
     except Exception as e:
         print(f"Errore calcolo prezzo: {e}")
         return 0.0, {}
+
+def registra_transazioni_batch(supabase, fascicolo_id, results, model_name):
+    """
+    Pricing di un intero batch (output di ai_engine.genera_docs_json_batch).
+    Moltiplicatore e listino letti una volta sola (dalla cache dati di riferimento,
+    al massimo una query per tabella), poi calcolo in memoria per ogni documento.
+    Restituisce: {doc_name: (prezzo_finale, doc_snapshot)}
+    """
+    if not supabase: return {k: (0.0, {}) for k in results}
+
+    try:
+        model_multiplier = get_moltiplicatore_modello(supabase, model_name)
+        listino = get_listino_completo(supabase)
+    except Exception as e:
+        print(f"Errore calcolo prezzo: {e}")
+        return {k: (0.0, {}) for k in results}
+
+    out = {}
+    for doc_type, doc_data in results.items():
+        metrics = (doc_data or {}).get("_metrics") or {}
+        try:
+            out[doc_type] = _calcola_prezzo_doc(
+                doc_type, model_name, model_multiplier, listino.get(doc_type),
+                metrics.get("tokens_input", 0) or 0, metrics.get("tokens_output", 0) or 0,
+                metrics.get("cached", False)
+            )
+        except Exception as e:
+            print(f"Errore calcolo prezzo {doc_type}: {e}")
+            out[doc_type] = (0.0, {})
+    return out
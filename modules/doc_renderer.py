@@ -2,45 +2,420 @@
 from docx import Document
 from docx.shared import Pt
 from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.table import _Cell
 from pypdf import PdfReader
 from io import BytesIO
-import zipfile
+from collections import OrderedDict, deque
+import os
 import re
+import copy
+import gzip
+import json
+import hashlib
+import shutil
+import tempfile
+import multiprocessing
+import zipfile
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from . import config, telemetry
+
+# --- CACHE ESTRAZIONE ---
+# Da incrementare quando cambia la logica di estrazione: invalida le voci vecchie
+EXTRACTOR_VERSION = "2"
+
+class _DiskCacheWriter:
+    """Scrittura in streaming di una voce di cache su disco (gzip, commit atomico)"""
+    def __init__(self, path, on_commit=None):
+        self.path = path
+        self.tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self.fh = gzip.open(self.tmp, "wt", encoding="utf-8")
+        self.on_commit = on_commit
+
+    def write(self, txt):
+        self.fh.write(txt)
+
+    def commit(self):
+        self.fh.close()
+        os.replace(self.tmp, self.path)
+        if self.on_commit: self.on_commit()
+
+    def abort(self):
+        try:
+            self.fh.close()
+            os.remove(self.tmp)
+        except Exception: pass
 
-def extract_text_from_files(uploaded_files):
+class ExtractionCache:
     """
-    Estrae testo da PDF, DOCX e TXT caricati.
-    Restituisce: (lista_parti, testo_completo)
+    Cache del testo estratto, chiave = SHA-256 dei byte del file + versione estrattore.
+    LRU limitato in memoria di processo + copia opzionale su disco (gzip),
+    così ogni documento viene parsato una volta per server e non a ogni rerun.
+    I testi più grandi di config.EXTRACT_CACHE_MAX_TEXT_MB restano solo su disco.
+    Il disco ha un tetto (max_disk_bytes) con eviction LRU, ultimo accesso = mtime come in RenderCache.
     """
-    parts = []
-    full_text = ""
-    parts.append("FASCICOLO DOCUMENTALE:\n")
-    
-    if not uploaded_files: 
-        return [], ""
-    
-    for file in uploaded_files:
+    def __init__(self, max_entries, disk_dir=None, max_text_bytes=None, max_disk_bytes=None):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes or int(config.EXTRACT_CACHE_MAX_MB * 1024 * 1024)
+        self.max_text_bytes = max_text_bytes or int(config.EXTRACT_CACHE_MAX_TEXT_MB * 1024 * 1024)
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits_mem": 0, "hits_disk": 0, "misses": 0, "evicted": 0}
+
+    @staticmethod
+    def make_key(data):
+        return f"{hashlib.sha256(data).hexdigest()}_v{EXTRACTOR_VERSION}"
+
+    @staticmethod
+    def key_for_upload(file, block=1024 * 1024):
+        """Hash in streaming del file caricato (senza copiarne i byte)"""
+        h = hashlib.sha256()
+        file.seek(0)
+        for piece in iter(lambda: file.read(block), b""):
+            h.update(piece)
+        file.seek(0)
+        return f"{h.hexdigest()}_v{EXTRACTOR_VERSION}"
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.txt.gz")
+
+    def get(self, key):
+        """Solo memoria; per il disco vedi iter_disk"""
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+                self.stats["hits_mem"] += 1
+                return self._mem[key]
+        return None
+
+    def record_miss(self):
+        with self._lock: self.stats["misses"] += 1
+
+    def iter_disk(self, key, block=256 * 1024):
+        """Legge una voce dal disco a blocchi (None se assente)"""
+        if not self.disk_dir: return None
+        path = self._disk_path(key)
+        if not os.path.exists(path): return None
+        try: os.utime(path)
+        except OSError: return None  # rimossa dall'eviction nel frattempo
+        with self._lock: self.stats["hits_disk"] += 1
+        def _gen():
+            with gzip.open(path, "rt", encoding="utf-8") as fh:
+                for piece in iter(lambda: fh.read(block), ""):
+                    yield piece
+        return _gen()
+
+    def put_mem(self, key, txt, nbytes=None):
+        """nbytes: dimensione UTF-8 già nota (evita di ricodificare il testo)"""
+        if nbytes is None: nbytes = len(txt.encode("utf-8"))
+        if nbytes > self.max_text_bytes: return
+        with self._lock:
+            self._mem[key] = txt
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.max_entries:
+                self._mem.popitem(last=False)
+
+    def open_disk_writer(self, key):
+        if not self.disk_dir: return None
         try:
-            txt = ""
-            if file.type == "application/pdf":
-                reader = PdfReader(file)
-                # Estrae testo da tutte le pagine se presente
-                txt = "\n".join([p.extract_text() for p in reader.pages if p.extract_text()])
-            elif "word" in file.type or "docx" in file.name:
-                doc = Document(file)
-                txt = "\n".join([p.text for p in doc.paragraphs])
-            else:
-                # Fallback per file testo
-                txt = str(file.read(), "utf-8")
-                
-            # Aggiungiamo separatori chiari per l'AI
-            header = f"\n--- DOCUMENTO CARICATO: {file.name} ---\n"
-            parts.append(f"{header}{txt}")
-            full_text += f"{header}{txt}"
-        except Exception as e: 
-            parts.append(f"Errore lettura file {file.name}: {str(e)}")
-            
-    return parts, full_text
+            os.makedirs(self.disk_dir, exist_ok=True)
+            return _DiskCacheWriter(self._disk_path(key), on_commit=self._prune_disk)
+        except Exception as e:
+            print(f"Cache estrazione su disco non scrivibile: {e}")
+            return None
+
+    def _prune_disk(self):
+        """Dopo ogni scrittura: rimuove le voci meno usate finché il totale rientra nel tetto"""
+        entries = []
+        with os.scandir(self.disk_dir) as it:
+            for e in it:
+                if not e.name.endswith(".txt.gz"): continue
+                try: st_ = e.stat()
+                except FileNotFoundError: continue
+                entries.append((st_.st_mtime, st_.st_size, e.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes: break
+            try: os.remove(path)
+            except FileNotFoundError: pass
+            total -= size
+            with self._lock: self.stats["evicted"] += 1
+
+    def set(self, key, txt):
+        self.put_mem(key, txt)
+        w = self.open_disk_writer(key)
+        if w:
+            try:
+                w.write(txt)
+                w.commit()
+            except Exception as e:
+                w.abort()
+                print(f"Cache estrazione su disco non scrivibile: {e}")
+
+_extraction_cache = ExtractionCache(config.EXTRACT_CACHE_MAX_ENTRIES, config.EXTRACT_CACHE_DIR)
+
+def get_extraction_cache():
+    return _extraction_cache
+
+# --- STORE TESTO ESTRATTO (memoria limitata per sessione) ---
+class ExtractedTextStore:
+    """
+    Archivio append-only dei record (file, pagina, testo) estratti in una sessione.
+    Il testo sta in RAM fino a config.EXTRACT_SESSION_MEMORY_MB, poi viene
+    riversato automaticamente su un file temporaneo (SpooledTemporaryFile).
+    In sessione resta solo l'indice degli offset.
+    """
+    SEGMENT_CHARS = 64 * 1024  # record lunghi spezzati: letture puntuali sempre piccole
+
+    def __init__(self, memory_ceiling_bytes=None):
+        self.memory_ceiling = int(memory_ceiling_bytes or config.EXTRACT_SESSION_MEMORY_MB * 1024 * 1024)
+        self._buf = tempfile.SpooledTemporaryFile(max_size=self.memory_ceiling, mode="w+b")
+        self._lock = threading.Lock()
+        self.records = []   # (file_name, pagina, offset, lunghezza, continuazione)
+        self.errors = []
+        self.size_bytes = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def spilled(self):
+        return bool(getattr(self._buf, "_rolled", False))
+
+    def append(self, file_name, page, text, continuation=False):
+        """continuation=True: il testo prosegue il record precedente (nessun a capo)"""
+        if not text: return
+        for i in range(0, len(text), self.SEGMENT_CHARS):
+            data = text[i:i + self.SEGMENT_CHARS].encode("utf-8")
+            with self._lock:
+                self._buf.seek(0, os.SEEK_END)
+                off = self._buf.tell()
+                self._buf.write(data)
+                self.records.append((file_name, page, off, len(data), continuation or i > 0))
+                self.size_bytes += len(data)
+
+    def read_record(self, idx):
+        _, _, off, length, _ = self.records[idx]
+        with self._lock:
+            self._buf.seek(off)
+            return self._buf.read(length).decode("utf-8")
+
+    def iter_records(self):
+        """Generatore (indice, file_name, pagina, testo)"""
+        for idx, rec in enumerate(self.records):
+            yield idx, rec[0], rec[1], self.read_record(idx)
+
+    def file_names(self):
+        return list(dict.fromkeys(r[0] for r in self.records))
+
+    def copy_excluding(self, file_names):
+        """Nuovo store con tutti i file tranne quelli indicati (es. ricaricati dall'utente)"""
+        out = ExtractedTextStore(self.memory_ceiling)
+        for idx, rec in enumerate(self.records):
+            if rec[0] in file_names: continue
+            out.append(rec[0], rec[1], self.read_record(idx), continuation=rec[4])
+        return out
+
+    # Serializzazione: JSONL compresso, un record per riga (scrittura/lettura in streaming)
+    # Prima riga = intestazione di formato. Gli archivi senza intestazione (formato 1) possono
+    # contenere testi da cache su disco spezzati in più record: load() li ricuce.
+    DUMP_FORMAT = 2
+
+    def dump(self, fh):
+        with gzip.GzipFile(fileobj=fh, mode="wb") as gz:
+            gz.write((json.dumps({"v": self.DUMP_FORMAT}) + "\n").encode("utf-8"))
+            for idx, rec in enumerate(self.records):
+                row = {"f": rec[0], "p": rec[1], "c": rec[4], "t": self.read_record(idx)}
+                gz.write((json.dumps(row, ensure_ascii=False) + "\n").encode("utf-8"))
+
+    @classmethod
+    def load(cls, fh, memory_ceiling_bytes=None):
+        store = cls(memory_ceiling_bytes)
+        legacy = True
+        prev = None
+        with gzip.GzipFile(fileobj=fh, mode="rb") as gz:
+            for line in gz:
+                row = json.loads(line)
+                if "v" in row:
+                    legacy = False
+                    continue
+                cont = row.get("c", False)
+                # Formato 1: i blocchi di una hit su disco (pagina None) erano record separati
+                if legacy and not cont and prev and prev["f"] == row["f"] and prev.get("p") is None and row.get("p") is None:
+                    cont = True
+                store.append(row["f"], row.get("p"), row["t"], continuation=cont)
+                prev = row
+        return store
+
+    def close(self):
+        try: self._buf.close()
+        except Exception: pass
+
+# --- ESTRAZIONE PDF PARALLELA ---
+def _mp_context():
+    """
+    Avvio dei processi worker: mai fork nel server Streamlit multithread (write-behind,
+    outbox, telemetria, httpx), il figlio erediterebbe lock tenuti da altri thread.
+    """
+    method = config.MP_START_METHOD
+    if method not in multiprocessing.get_all_start_methods(): method = "spawn"
+    return multiprocessing.get_context(method)
+
+def _extract_pdf_pages(path, start, end):
+    """Worker: estrae le pagine [start, end) chiamando extract_text una sola volta per pagina"""
+    reader = PdfReader(path)
+    out = []
+    for i in range(start, end):
+        try: out.append(reader.pages[i].extract_text() or "")
+        except Exception: out.append("")
+    return start, out
+
+def _extract_pdf_shard(args):
+    return _extract_pdf_pages(*args)
+
+def _iter_pdf_pages(name, file, progress_cb=None):
+    """Generatore (n_pagina, testo) in ordine di pagina"""
+    file.seek(0)
+    reader = PdfReader(file)
+    n_pages = len(reader.pages)
+    deadline = time.monotonic() + config.PDF_EXTRACT_TIMEOUT
+
+    # PDF piccoli: nel thread corrente, senza costo di avvio processi
+    if n_pages < config.PDF_PARALLEL_MIN_PAGES:
+        for i, page in enumerate(reader.pages):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"estrazione oltre {config.PDF_EXTRACT_TIMEOUT}s")
+            yield i + 1, page.extract_text() or ""
+            if progress_cb: progress_cb(name, i + 1, n_pages)
+        return
+
+    # I worker ricevono il percorso di una copia temporanea, non i byte del PDF per ogni blocco
+    file.seek(0)
+    with tempfile.NamedTemporaryFile(prefix="lexv_pdf_", suffix=".pdf", delete=False) as tmp:
+        shutil.copyfileobj(file, tmp)
+    step = config.PDF_PAGES_PER_SHARD
+    shards = [(tmp.name, a, min(a + step, n_pages)) for a in range(0, n_pages, step)]
+    # Pool dedicato all'estrazione: un timeout termina solo i processi di questo file
+    workers = max(1, min(config.PDF_EXTRACT_WORKERS, os.cpu_count() or 1, len(shards)))
+    pool = _mp_context().Pool(workers)
+    finished = False
+    pending = {}   # blocchi arrivati fuori ordine
+    next_start = 0
+    done_pages = 0
+    try:
+        results = pool.imap_unordered(_extract_pdf_shard, shards)
+        for _ in shards:
+            start, page_texts = results.next(timeout=max(0.0, deadline - time.monotonic()))
+            pending[start] = page_texts
+            done_pages += len(page_texts)
+            if progress_cb: progress_cb(name, done_pages, n_pages)
+            while next_start in pending:
+                block = pending.pop(next_start)
+                for j, txt in enumerate(block):
+                    yield next_start + j + 1, txt
+                next_start += len(block)
+        finished = True
+    except multiprocessing.TimeoutError:
+        raise TimeoutError(f"estrazione oltre {config.PDF_EXTRACT_TIMEOUT}s ({done_pages}/{n_pages} pagine)")
+    finally:
+        # Timeout, errore o generatore chiuso in anticipo: i worker ancora attivi vengono terminati
+        if finished: pool.close()
+        else: pool.terminate()
+        pool.join()
+        try: os.unlink(tmp.name)
+        except OSError: pass
+
+def _iter_single(name, mime, file, progress_cb=None):
+    """Generatore (pagina, testo) di un singolo file; pagina=None per formati senza pagine"""
+    if mime == "application/pdf":
+        yield from _iter_pdf_pages(name, file, progress_cb)
+    elif "word" in mime or "docx" in name:
+        file.seek(0)
+        doc = Document(file)
+        yield None, "\n".join([p.text for p in doc.paragraphs])
+    else:
+        # Fallback per file testo
+        file.seek(0)
+        yield None, str(file.read(), "utf-8")
+
+def iter_extracted_pages(uploaded_files, progress_cb=None, errors=None):
+    """
+    Pipeline di estrazione in streaming: genera record (file_name, pagina, testo, continuazione)
+    senza mai tenere in memoria l'intero fascicolo. continuazione=True: il testo prosegue
+    il record precedente dello stesso file (blocchi letti dalla cache su disco).
+    Usa la cache per hash del contenuto; i file illeggibili finiscono in errors (lista).
+    """
+    cache = get_extraction_cache()
+    for file in uploaded_files or []:
+        try:
+            key = cache.key_for_upload(file)
+            txt = cache.get(key)
+            if txt is not None:
+                yield file.name, None, txt, False
+                continue
+            disk = cache.iter_disk(key)
+            if disk is not None:
+                # Un solo record logico: i blocchi dopo il primo sono continuazioni
+                for i, piece in enumerate(disk):
+                    yield file.name, None, piece, i > 0
+                continue
+
+            # Miss: estraiamo pagina per pagina, scrivendo in parallelo la cache
+            cache.record_miss()
+            writer = cache.open_disk_writer(key)
+            small = []   # accumulo per la cache in memoria, abbandonato se il file è troppo grande
+            small_bytes = 0
+            first = True
+            try:
+                for page, txt in _iter_single(file.name, file.type, file, progress_cb):
+                    if not txt: continue
+                    chunk = txt if first else "\n" + txt
+                    first = False
+                    if writer: writer.write(chunk)
+                    if small is not None:
+                        small.append(chunk)
+                        small_bytes += len(chunk.encode("utf-8"))
+                        if small_bytes > cache.max_text_bytes: small = None
+                    yield file.name, page, txt, False
+            except BaseException:
+                # Anche GeneratorExit (consumatore interrotto): niente .tmp orfani
+                if writer: writer.abort()
+                raise
+            if writer: writer.commit()
+            if small is not None: cache.put_mem(key, "".join(small), small_bytes)
+        except Exception as e:
+            msg = f"Errore lettura file {file.name}: {str(e)}"
+            if errors is not None: errors.append(msg)
+            else: print(msg)
+
+@telemetry.traccia("render", "estrazione", bytes_of=lambda s: s.size_bytes)
+def extract_to_store(uploaded_files, progress_cb=None, store=None):
+    """Estrae i file caricati in un ExtractedTextStore (memoria limitata)"""
+    if store is None: store = ExtractedTextStore()
+    for name, page, txt, cont in iter_extracted_pages(uploaded_files, progress_cb, errors=store.errors):
+        store.append(name, page, txt, continuation=cont)
+    return store
+
+def add_table_fast(doc, table_data, style='Table Grid'):
+    """
+    Tabella Word da righe di celle in una sola passata.
+    tbl.cell(i, j) ricostruisce la griglia a ogni chiamata (costo quadratico):
+    qui lo scheletro XML viene creato in un colpo e le celle <w:tc> si
+    riempiono scorrendo direttamente le righe. Output XML identico.
+    """
+    rows = len(table_data)
+    cols = max(len(r) for r in table_data) if rows>0 else 0
+    if not (rows>0 and cols>0): return None
+    tbl = doc.add_table(rows, cols)
+    try: tbl.style = style  # stile applicato una volta sola
+    except KeyError: pass   # template di studio senza lo stile richiesto
+    for tr, r in zip(tbl._tbl.tr_lst, table_data):
+        for tc, c in zip(tr.tc_lst, r):
+            _Cell(tc, tbl).text = c
+    return tbl
 
 def parse_markdown_pro(doc, text):
     """
@@ -64,15 +439,7 @@ def parse_markdown_pro(doc, text):
             
         if in_table:
             # Fine tabella rilevata, renderizziamo
-            if table_data:
-                rows = len(table_data)
-                cols = max(len(r) for r in table_data) if rows>0 else 0
-                if rows>0 and cols>0:
-                    tbl = doc.add_table(rows, cols)
-                    tbl.style = 'Table Grid'
-                    for i,r in enumerate(table_data):
-                        for j,c in enumerate(r):
-                            if j<cols: tbl.cell(i,j).text = c
+            if table_data: add_table_fast(doc, table_data)
             in_table=False; table_data=[]
         
         if not stripped: continue
@@ -85,33 +452,315 @@ def parse_markdown_pro(doc, text):
             
         # 3. Gestione Liste (- o *)
         elif stripped.startswith('- ') or stripped.startswith('* '):
-            doc.add_paragraph(stripped[2:], style='List Bullet')
+            p = doc.add_paragraph(stripped[2:])
+            try: p.style = 'List Bullet'
+            except KeyError: p.text = f"• {stripped[2:]}"  # template di studio senza elenchi puntati
             
         # 4. Paragrafi normali
         else:
             p = doc.add_paragraph(stripped)
             p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
 
-def create_zip(docs_dict, sanitizer):
-    """Crea lo ZIP finale con i documenti Word"""
-    buf = BytesIO()
-    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
-        for name, data in docs_dict.items():
-            doc = Document()
-            
-            # Titolo Documento
-            titolo_doc = data.get("titolo", name)
-            doc.add_heading(titolo_doc, 0)
-            
-            # Contenuto (Restore privacy -> Parse Markdown -> Word)
-            raw_content = data.get("contenuto", "")
-            real_content = sanitizer.restore(raw_content)
-            parse_markdown_pro(doc, real_content)
-            
-            # Salvataggio in memoria
-            b = BytesIO()
-            doc.save(b)
-            z.writestr(f"{name}.docx", b.getvalue())
+# --- TEMPLATE STUDIO ---
+def _slug_studio(nome_studio):
+    return re.sub(r"[^a-z0-9]+", "_", (nome_studio or "").lower()).strip("_")
+
+def resolve_template(nome_studio=None):
+    """Percorso del template .docx dello studio (o default.docx), None = template python-docx"""
+    base_dir = config.DOCX_TEMPLATES_DIR
+    if not base_dir or not os.path.isdir(base_dir): return None
+    slug = _slug_studio(nome_studio)
+    for fn in ([f"{slug}.docx"] if slug else []) + ["default.docx"]:
+        path = os.path.join(base_dir, fn)
+        if os.path.isfile(path): return path
+    return None
+
+class TemplateRegistry:
+    """
+    Template Word parsati una sola volta per processo.
+    Ogni nuovo documento è una deepcopy del template già in memoria:
+    niente unzip e parsing XML del pacchetto a ogni Document().
+    Un template modificato su disco (mtime diverso) viene ricaricato.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bases = {}   # path|None -> (mtime, Document, fingerprint)
+
+    def _entry(self, path):
+        mtime = os.path.getmtime(path) if path else 0
+        with self._lock:
+            cached = self._bases.get(path)
+            if cached and cached[0] == mtime: return cached
+            if path:
+                with open(path, "rb") as fh:
+                    data = fh.read()
+                base = Document(BytesIO(data))
+                fingerprint = hashlib.sha256(data).hexdigest()[:16]
+            else:
+                base = Document()
+                fingerprint = "python-docx-default"
+            self._bases[path] = (mtime, base, fingerprint)
+            return self._bases[path]
+
+    def fingerprint(self, path):
+        """Identità del template (entra nella chiave della cache di rendering)"""
+        return self._entry(path)[2]
+
+    def new_document(self, path=None):
+        return copy.deepcopy(self._entry(path)[1])
+
+_template_registry = TemplateRegistry()
+
+def get_template_registry():
+    return _template_registry
+
+# --- RENDERING DOCX E ZIP ---
+def render_docx_bytes(name, titolo_doc, real_content, template_path=None):
+    """Renderizza un documento Word (contenuto già de-anonimizzato) e ne restituisce i byte"""
+    doc = get_template_registry().new_document(template_path)
+    
+    # Titolo Documento
+    doc.add_heading(titolo_doc, 0)
+    
+    # Contenuto (Parse Markdown -> Word)
+    parse_markdown_pro(doc, real_content)
+    
+    b = BytesIO()
+    doc.save(b)
+    return b.getvalue()
+
+# Da incrementare quando cambia l'output di parse_markdown_pro/render_docx_bytes
+RENDERER_VERSION = "1"
+
+class RenderCache:
+    """
+    Cache su disco dei .docx finiti, chiave = hash(titolo, contenuto, versione renderer).
+    Eviction LRU per dimensione totale (ultimo accesso = mtime del file).
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = None   # key -> [size, last_access], caricato al primo uso
+        self.stats = {"hits": 0, "misses": 0, "evicted": 0}
+
+    @staticmethod
+    def make_key(titolo_doc, real_content, template_id=""):
+        h = hashlib.sha256()
+        for part in (RENDERER_VERSION, template_id or "", titolo_doc or "", real_content or ""):
+            h.update(part.encode("utf-8"))
+            h.update(b"\x00")
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.docx")
+
+    def _load_index(self):
+        if self._index is not None: return
+        self._index = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for fn in os.listdir(self.cache_dir):
+            if not fn.endswith(".docx"): continue
+            st_ = os.stat(os.path.join(self.cache_dir, fn))
+            self._index[fn[:-5]] = [st_.st_size, st_.st_mtime]
+
+    def get(self, key):
+        with self._lock:
+            self._load_index()
+            if key not in self._index:
+                self.stats["misses"] += 1
+                return None
+            try:
+                with open(self._path(key), "rb") as fh:
+                    data = fh.read()
+            except FileNotFoundError:
+                self._index.pop(key, None)
+                self.stats["misses"] += 1
+                return None
+            now = time.time()
+            self._index[key][1] = now
+            try: os.utime(self._path(key), (now, now))
+            except OSError: pass
+            self.stats["hits"] += 1
+            return data
+
+    def contains(self, key):
+        """Presenza nell'indice, senza leggere il file (get può comunque mancare se evicted nel frattempo)"""
+        with self._lock:
+            self._load_index()
+            if key in self._index: return True
+            self.stats["misses"] += 1
+            return False
+
+    def set(self, key, data):
+        with self._lock:
+            self._load_index()
+            tmp = f"{self._path(key)}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp, self._path(key))
+            self._index[key] = [len(data), time.time()]
+            total = sum(v[0] for v in self._index.values())
+            if total <= self.max_bytes: return
+            for old_key, (size, _) in sorted(self._index.items(), key=lambda kv: kv[1][1]):
+                if total <= self.max_bytes or old_key == key: continue
+                try: os.remove(self._path(old_key))
+                except OSError: pass
+                del self._index[old_key]
+                total -= size
+                self.stats["evicted"] += 1
+
+_render_cache = None
+if config.RENDER_CACHE_DIR:
+    _render_cache = RenderCache(config.RENDER_CACHE_DIR, int(config.RENDER_CACHE_MAX_MB * 1024 * 1024))
+
+def get_render_cache():
+    return _render_cache
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+def _get_render_pool():
+    """Pool di processi condiviso per il rendering (creato al primo bundle grande)"""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            workers = max(1, min(config.RENDER_WORKERS, os.cpu_count() or 1))
+            _render_pool = ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context())
+        return _render_pool
+
+def _reset_render_pool(pool):
+    """Pool rotto (worker morto): lo scarta, il prossimo bundle ne crea uno nuovo"""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is pool: _render_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+class ZipBundle:
+    """
+    Handle dello ZIP generato: i byte stanno in un file temporaneo (spooled),
+    non in session_state. Il download (st.download_button) li legge con read_bytes().
+    Da chiudere quando il bundle non serve più.
+    """
+    def __init__(self, fh, n_docs, names=None):
+        self.fh = fh
+        self.n_docs = n_docs
+        self.names = names or []
+        fh.seek(0, os.SEEK_END)
+        self.size = fh.tell()
+        fh.seek(0)
+
+    def open(self):
+        """File-like posizionato all'inizio (es. per copiarlo su disco o in streaming)"""
+        self.fh.seek(0)
+        return self.fh
+
+    def read_bytes(self):
+        self.fh.seek(0)
+        return self.fh.read()
+
+    # Compatibilità con il vecchio BytesIO restituito da create_zip
+    def getvalue(self):
+        return self.read_bytes()
+
+    def close(self):
+        try: self.fh.close()
+        except Exception: pass
+
+def _iter_rendered(jobs, cache=None):
+    """
+    Genera (nome, byte_docx) nell'ordine dei job.
+    I documenti già in cache non vengono renderizzati; gli altri, se sono molti,
+    vanno sul pool di processi con una finestra limitata di job in volo,
+    così la memoria di picco non cresce con la dimensione del bundle.
+    """
+    registry = get_template_registry()
+    keys = [cache.make_key(j[1], j[2], registry.fingerprint(j[3])) if cache else None for j in jobs]
+    # Solo la presenza: i byte delle hit si leggono quando tocca a loro
+    cached = [bool(cache) and cache.contains(k) for k in keys]
+    n_miss = sum(1 for c in cached if not c)
+
+    def _store(key, data):
+        if cache:
+            try: cache.set(key, data)
+            except Exception as e: print(f"Cache rendering non scrivibile: {e}")
+        return data
+
+    def _hit(job, key):
+        data = cache.get(key)
+        # Evicted tra contains() e get(): si renderizza qui
+        return data if data is not None else _store(key, render_docx_bytes(*job))
+
+    if n_miss < config.RENDER_PARALLEL_MIN_DOCS:
+        for job, key, hit in zip(jobs, keys, cached):
+            yield job[0], _hit(job, key) if hit else _store(key, render_docx_bytes(*job))
+        return
+
+    pool = _get_render_pool()
+    window = max(1, min(config.RENDER_WORKERS, os.cpu_count() or 1)) * 2
+    inflight = deque()
+    n_running = 0
+    broken = False
+
+    def _submit(job):
+        # Dopo un BrokenProcessPool i job restanti si renderizzano nel thread corrente
+        nonlocal broken
+        if broken: return None
+        try: return pool.submit(render_docx_bytes, *job)
+        except BrokenProcessPool:
+            broken = True
+            _reset_render_pool(pool)
+            return None
+
+    it = iter(zip(jobs, keys, cached))
+    for job, key, hit in it:
+        # I cache hit restano in coda (solo la chiave), i miss occupano la finestra
+        inflight.append((job, key, hit, None if hit else _submit(job)))
+        if hit: continue
+        n_running += 1
+        if n_running >= window: break
+    while inflight:
+        job, key, hit, fut = inflight.popleft()
+        if hit:
+            yield job[0], _hit(job, key)
+            continue
+        n_running -= 1
+        data = None
+        if fut is not None:
+            try: data = fut.result()
+            except BrokenProcessPool:
+                print("Pool di rendering interrotto: rendering nel processo principale")
+                if not broken:
+                    broken = True
+                    _reset_render_pool(pool)
+        if data is None: data = render_docx_bytes(*job)
+        yield job[0], _store(key, data)
+        for job, key, hit in it:
+            inflight.append((job, key, hit, None if hit else _submit(job)))
+            if hit: continue
+            n_running += 1
+            break
+
+@telemetry.traccia("render", "zip_docx", bytes_of=lambda z: z.size)
+def create_zip(docs_dict, sanitizer, nome_studio=None):
+    """
+    Crea lo ZIP finale con i documenti Word.
+    Documenti invariati presi dalla cache di rendering; gli altri renderizzati in parallelo.
+    Voci ZIP scritte in streaming su file temporaneo.
+    nome_studio: sceglie il template Word dello studio (carta intestata), se presente.
+    Restituisce uno ZipBundle (handle), non i byte.
+    """
+    template_path = resolve_template(nome_studio)
+    jobs = []
+    for name, data in docs_dict.items():
+        # Restore privacy nel processo principale (il sanitizer resta qui)
+        titolo_doc = data.get("titolo", name)
+        real_content = sanitizer.restore(data.get("contenuto", ""))
+        jobs.append((name, titolo_doc, real_content, template_path))
+
+    fh = tempfile.SpooledTemporaryFile(max_size=int(config.ZIP_SPOOL_MAX_MB * 1024 * 1024), mode="w+b")
+    with zipfile.ZipFile(fh, "w", zipfile.ZIP_DEFLATED) as z:
+        for name, docx_bytes in _iter_rendered(jobs, get_render_cache()):
+            z.writestr(f"{name}.docx", docx_bytes)
     
-    buf.seek(0)
-    return buf
+    return ZipBundle(fh, len(jobs), [j[0] for j in jobs])
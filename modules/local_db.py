@@ -0,0 +1,470 @@
+# modules/local_db.py
+"""
+Backend SQLite locale (WAL) con la stessa interfaccia del client Supabase usata dai moduli:
+table(...).select/insert/upsert/update/delete + eq/neq/lt/lte/gt/gte/in_/or_/order/limit + execute(),
+e rpc(nome, parametri). Serve per girare senza rete, per i test e per i benchmark di carico.
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from . import config
+
+# Tipi logici: "uuid" / "identity" = chiave primaria, "json" e "bool" convertiti in lettura/scrittura,
+# "timestamp" = ISO 8601 UTC (ordinabile come testo). Il resto è SQL SQLite così com'è.
+TABLES = {
+    "profili_utenti": {
+        "id": "uuid",
+        "email": "TEXT UNIQUE",
+        "password": "TEXT",
+        "nome_studio": "TEXT",
+        "ruolo": "TEXT DEFAULT 'user'",
+        "stato_account": "TEXT DEFAULT 'in_attesa'",
+        "created_at": "timestamp",
+    },
+    "fascicoli": {
+        "id": "uuid",
+        "user_id": "TEXT",
+        "nome_riferimento": "TEXT",
+        "tipo_causa": "TEXT",
+        "nome_cliente": "TEXT",
+        "nome_controparte": "TEXT",
+        "metadata": "json",
+        "stato": "TEXT",
+        "livello_aggressivita": "INTEGER DEFAULT 5",
+        "dati_tecnici": "TEXT",
+        "documenti_generati": "json",
+        "testi_estratti": "json",
+        "costo_stimato": "REAL DEFAULT 0",
+        "created_at": "timestamp",
+    },
+    "listino_prezzi": {
+        "id": "identity",
+        "tipo_documento": "TEXT",
+        "prezzo_fisso": "REAL DEFAULT 0",
+        "prezzo_per_1k_input_token": "REAL DEFAULT 0",
+        "prezzo_per_1k_output_token": "REAL DEFAULT 0",
+        "moltiplicatore_complessita": "REAL DEFAULT 1",
+        "descrizione": "TEXT",
+        "created_at": "timestamp",
+    },
+    "gemini_models": {
+        "id": "identity",
+        "model_name": "TEXT",
+        "display_name": "TEXT",
+        "is_active": "bool DEFAULT 1",
+        "price_multiplier": "REAL DEFAULT 1",
+        "created_at": "timestamp",
+    },
+    "config_tipi_causa": {
+        "id": "identity",
+        "codice": "TEXT",
+        "nome_visualizzato": "TEXT",
+    },
+    "documenti_fascicolo": {
+        "id": "identity",
+        "fascicolo_id": "TEXT NOT NULL REFERENCES fascicoli(id) ON DELETE CASCADE",
+        "titolo": "TEXT NOT NULL",
+        "tipo": "TEXT NOT NULL DEFAULT 'auto_generato'",
+        "contenuto": "TEXT",
+        "data_creazione": "TEXT",
+        "metadata_pricing": "json",
+        "legacy_pos": "INTEGER",
+        "created_at": "timestamp",
+    },
+    "messaggi_chat": {
+        "id": "identity",
+        "fascicolo_id": "TEXT NOT NULL REFERENCES fascicoli(id) ON DELETE CASCADE",
+        "role": "TEXT NOT NULL",
+        "content": "TEXT NOT NULL",
+        "archiviato": "bool NOT NULL DEFAULT 0",
+        "created_at": "timestamp",
+    },
+}
+
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS fascicoli_user_keyset ON fascicoli(user_id, created_at DESC, id DESC)",
+    "CREATE INDEX IF NOT EXISTS documenti_fascicolo_fid ON documenti_fascicolo(fascicolo_id, created_at)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS documenti_fascicolo_legacy ON documenti_fascicolo(fascicolo_id, legacy_pos)",
+    "CREATE INDEX IF NOT EXISTS messaggi_chat_fid ON messaggi_chat(fascicolo_id, archiviato, id DESC)",
+    "CREATE INDEX IF NOT EXISTS profili_utenti_stato ON profili_utenti(stato_account)",
+]
+
+_TYPE_SQL = {
+    "uuid": "TEXT PRIMARY KEY",
+    "identity": "INTEGER PRIMARY KEY AUTOINCREMENT",
+    "timestamp": "TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))",
+}
+
+def _kind(decl):
+    return decl.split()[0]
+
+def _column_sql(decl):
+    k = _kind(decl)
+    if k in _TYPE_SQL: return _TYPE_SQL[k]
+    if k == "json": return "TEXT" + decl[4:]
+    if k == "bool": return "INTEGER" + decl[4:]
+    return decl
+
+def _ddl(table, cols):
+    parts = [f"{name} {_column_sql(decl)}" for name, decl in cols.items()]
+    return f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(parts)})"
+
+def _now_iso():
+    return datetime.now(timezone.utc).isoformat(timespec="microseconds")
+
+class APIResponse:
+    """Stessa forma della risposta postgrest: .data (lista di righe o valore RPC) e .count"""
+    def __init__(self, data):
+        self.data = data
+        self.count = len(data) if isinstance(data, list) else None
+
+class LocalQuery:
+    """Query builder a catena, tradotto in una singola istruzione SQL all'execute()"""
+    _OPS = {"eq": "=", "neq": "!=", "lt": "<", "lte": "<=", "gt": ">", "gte": ">="}
+
+    def __init__(self, client, table):
+        if table not in TABLES: raise ValueError(f"Tabella sconosciuta: {table}")
+        self._client = client
+        self._table = table
+        self._cols = TABLES[table]
+        self._op = "select"
+        self._select = "*"
+        self._payload = None
+        self._where = []
+        self._params = []
+        self._order = []
+        self._limit = None
+
+    # --- Validazione ---
+    def _col(self, name):
+        name = name.strip()
+        if name not in self._cols: raise ValueError(f"Colonna sconosciuta: {self._table}.{name}")
+        return name
+
+    def _to_db(self, col, value):
+        k = _kind(self._cols[col])
+        if value is None: return None
+        if k == "json": return json.dumps(value, default=str)
+        if k == "bool": return 1 if value else 0
+        return value
+
+    def _from_db(self, row):
+        out = {}
+        for col, value in zip(row.keys(), row):
+            k = _kind(self._cols.get(col, "TEXT"))
+            if value is not None and k == "json": value = json.loads(value)
+            elif value is not None and k == "bool": value = bool(value)
+            out[col] = value
+        return out
+
+    # --- Operazioni ---
+    def select(self, columns="*", count=None):
+        self._op = "select"
+        self._select = columns
+        return self
+
+    def insert(self, rows):
+        self._op = "insert"
+        self._payload = rows if isinstance(rows, list) else [rows]
+        return self
+
+    def upsert(self, rows, on_conflict=None, ignore_duplicates=False):
+        """INSERT ... ON CONFLICT: ignore_duplicates=True salta le righe già presenti (DO NOTHING)"""
+        self._op = "upsert"
+        self._payload = rows if isinstance(rows, list) else [rows]
+        self._conflict = [self._col(c) for c in on_conflict.split(",")] if on_conflict else []
+        self._ignore_duplicates = ignore_duplicates
+        return self
+
+    def update(self, fields):
+        self._op = "update"
+        self._payload = fields
+        return self
+
+    def delete(self):
+        self._op = "delete"
+        return self
+
+    # --- Filtri ---
+    def _filter(self, col, op, value):
+        col = self._col(col)
+        if op == "is":
+            self._where.append(f"{col} IS NULL" if value in (None, "null") else f"{col} IS NOT NULL")
+        else:
+            self._where.append(f"{col} {self._OPS[op]} ?")
+            self._params.append(self._to_db(col, value) if _kind(self._cols[col]) == "bool" else value)
+        return self
+
+    def eq(self, col, value): return self._filter(col, "eq", value)
+    def neq(self, col, value): return self._filter(col, "neq", value)
+    def lt(self, col, value): return self._filter(col, "lt", value)
+    def lte(self, col, value): return self._filter(col, "lte", value)
+    def gt(self, col, value): return self._filter(col, "gt", value)
+    def gte(self, col, value): return self._filter(col, "gte", value)
+    def is_(self, col, value): return self._filter(col, "is", value)
+
+    def in_(self, col, values):
+        col = self._col(col)
+        values = list(values)
+        if not values:
+            self._where.append("0")
+        else:
+            self._where.append(f"{col} IN ({', '.join('?' * len(values))})")
+            self._params.extend(values)
+        return self
+
+    def or_(self, filters):
+        """Sintassi PostgREST: 'a.lt.1,and(a.eq.1,b.lt.2)' (valori anche tra doppi apici)"""
+        sql, params = self._parse_logic(filters, " OR ")
+        self._where.append(sql)
+        self._params.extend(params)
+        return self
+
+    @staticmethod
+    def _split_top(expr):
+        parts, depth, quoted, cur = [], 0, False, []
+        for ch in expr:
+            if ch == '"': quoted = not quoted
+            elif not quoted and ch == "(": depth += 1
+            elif not quoted and ch == ")": depth -= 1
+            if ch == "," and depth == 0 and not quoted:
+                parts.append("".join(cur)); cur = []
+            else:
+                cur.append(ch)
+        if cur: parts.append("".join(cur))
+        return [p.strip() for p in parts if p.strip()]
+
+    def _parse_logic(self, expr, joiner):
+        clauses, params = [], []
+        for part in self._split_top(expr):
+            m = re.match(r"^(and|or)\((.*)\)$", part, re.S)
+            if m:
+                sql, p = self._parse_logic(m.group(2), " AND " if m.group(1) == "and" else " OR ")
+            else:
+                col, op, value = part.split(".", 2)
+                col = self._col(col)
+                if len(value) >= 2 and value[0] == value[-1] == '"': value = value[1:-1]
+                if op == "is":
+                    sql, p = (f"{col} IS NULL", []) if value == "null" else (f"{col} IS NOT NULL", [])
+                elif op in self._OPS:
+                    sql, p = f"{col} {self._OPS[op]} ?", [value]
+                else:
+                    raise ValueError(f"Operatore non supportato: {op}")
+            clauses.append(sql)
+            params.extend(p)
+        return "(" + joiner.join(clauses) + ")", params
+
+    def order(self, col, desc=False):
+        self._order.append(f"{self._col(col)} {'DESC' if desc else 'ASC'}")
+        return self
+
+    def limit(self, n):
+        self._limit = int(n)
+        return self
+
+    # --- Esecuzione ---
+    def _where_sql(self):
+        return f" WHERE {' AND '.join(self._where)}" if self._where else ""
+
+    def _select_sql(self):
+        if self._select.strip() == "*": return "*"
+        return ", ".join(self._col(c) for c in self._select.split(","))
+
+    def _prepare_row(self, row):
+        row = dict(row)
+        for col, decl in self._cols.items():
+            k = _kind(decl)
+            if k == "uuid" and not row.get(col): row[col] = str(uuid.uuid4())
+            elif k == "timestamp" and not row.get(col): row[col] = _now_iso()
+        cols = [self._col(c) for c in row]
+        return cols, [self._to_db(c, row[c]) for c in cols]
+
+    def _conflict_sql(self, cols):
+        target = self._conflict or [c for c, d in self._cols.items() if _kind(d) in ("uuid", "identity")]
+        updates = [c for c in cols if c not in target]
+        if self._ignore_duplicates or not updates: return f" ON CONFLICT ({', '.join(target)}) DO NOTHING"
+        return f" ON CONFLICT ({', '.join(target)}) DO UPDATE SET " + ", ".join(f"{c} = excluded.{c}" for c in updates)
+
+    def execute(self):
+        return self._client._execute(self)
+
+    def _run(self, conn):
+        t = self._table
+        if self._op == "select":
+            sql = f"SELECT {self._select_sql()} FROM {t}{self._where_sql()}"
+            if self._order: sql += " ORDER BY " + ", ".join(self._order)
+            if self._limit is not None: sql += f" LIMIT {self._limit}"
+            return [self._from_db(r) for r in conn.execute(sql, self._params)]
+
+        if self._op in ("insert", "upsert"):
+            out = []
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                for row in self._payload:
+                    cols, values = self._prepare_row(row)
+                    sql = f"INSERT INTO {t} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})"
+                    if self._op == "upsert": sql += self._conflict_sql(cols)
+                    sql += " RETURNING *"
+                    out.extend(self._from_db(r) for r in conn.execute(sql, values).fetchall())
+            return out
+
+        if self._op == "update":
+            cols = [self._col(c) for c in self._payload]
+            if not cols: return []
+            sets = ", ".join(f"{c} = ?" for c in cols)
+            values = [self._to_db(c, self._payload[c]) for c in cols]
+            sql = f"UPDATE {t} SET {sets}{self._where_sql()} RETURNING *"
+            with conn:
+                return [self._from_db(r) for r in conn.execute(sql, values + self._params).fetchall()]
+
+        if self._op == "delete":
+            with conn:
+                return [self._from_db(r) for r in conn.execute(f"DELETE FROM {t}{self._where_sql()} RETURNING *", self._params).fetchall()]
+        raise ValueError(f"Operazione non supportata: {self._op}")
+
+class RpcNotFound(ValueError):
+    """Funzione RPC non registrata (stesso codice di PostgREST)"""
+    code = "PGRST202"
+
+class _RpcCall:
+    def __init__(self, client, name, params):
+        self._client, self._name, self._params = client, name, params
+
+    def execute(self):
+        handler = self._client._rpc.get(self._name)
+        if handler is None: raise RpcNotFound(f"Funzione RPC sconosciuta: {self._name}")
+        return APIResponse(handler(self._client.connection(), self._params or {}))
+
+class LocalClient:
+    """
+    Client SQLite con l'interfaccia del client Supabase (tabelle + rpc).
+    Una connessione per thread, WAL + busy timeout: letture concorrenti, scritture serializzate.
+    rpc = {nome: funzione(conn, parametri)} per le funzioni server-side (es. append_generazione).
+    admin = (email, password): account admin creato a database vuoto (nessuno se None).
+    """
+    is_local = True
+
+    def __init__(self, path, rpc=None, seed=True, admin=None):
+        self.path = path
+        self._admin = admin
+        self._rpc = dict(rpc or {})
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {"queries": 0, "seconds": 0.0}
+        if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = self.connection()
+        for table, cols in TABLES.items():
+            conn.execute(_ddl(table, cols))
+            # Database creati da una versione precedente: aggiunge le colonne nuove
+            esistenti = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}
+            for name, decl in cols.items():
+                if name not in esistenti: conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {_column_sql(decl)}")
+        for sql in INDEXES:
+            conn.execute(sql)
+        if seed: self._seed(conn)
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def _seed(self, conn):
+        """Dati minimi per usare l'app offline (solo a database vuoto)"""
+        if self._admin and not conn.execute("SELECT 1 FROM profili_utenti LIMIT 1").fetchone():
+            email, password = self._admin
+            self.table("profili_utenti").insert({
+                "email": email, "password": password, "nome_studio": "Locale",
+                "ruolo": "admin", "stato_account": "attivo"
+            }).execute()
+        if not conn.execute("SELECT 1 FROM gemini_models LIMIT 1").fetchone():
+            self.table("gemini_models").insert(list(config.LOCAL_DB_SEED_MODELS)).execute()
+
+    def table(self, name):
+        return LocalQuery(self, name)
+
+    def rpc(self, name, params=None):
+        return _RpcCall(self, name, params)
+
+    def _execute(self, query):
+        t0 = time.perf_counter()
+        try:
+            return APIResponse(query._run(self.connection()))
+        finally:
+            with self._stats_lock:
+                self._stats["queries"] += 1
+                self._stats["seconds"] += time.perf_counter() - t0
+
+    def stats(self):
+        with self._stats_lock:
+            out = dict(self._stats)
+        out["avg_ms"] = round(1000 * out["seconds"] / out["queries"], 3) if out["queries"] else 0.0
+        out["path"] = self.path
+        return out
+
+def benchmark(client, n_fascicoli=2000, n_docs=3, ripetizioni=50):
+    """
+    Carico realistico su un solo utente e latenza delle query calde della dashboard/workstation.
+    Stesse catene di query di database.py: il client può essere locale o Supabase.
+    Ritorna {query: ms medi}.
+    """
+    user = client.table("profili_utenti").insert({
+        "email": f"bench-{uuid.uuid4().hex[:8]}", "password": "x", "stato_account": "attivo"
+    }).execute().data[0]
+    ids = []
+    for i in range(n_fascicoli):
+        f = client.table("fascicoli").insert({
+            "user_id": user["id"], "nome_riferimento": f"Causa {i}", "tipo_causa": "immobiliare",
+            "nome_cliente": f"Cliente {i}", "nome_controparte": "Controparte",
+            "metadata": {"cliente_info": f"Cliente {i}"}, "stato": "in_lavorazione",
+            "dati_tecnici": "x" * 2000
+        }).execute().data[0]
+        ids.append(f["id"])
+        client.table("documenti_fascicolo").insert([
+            {"fascicolo_id": f["id"], "titolo": f"Doc {j}", "tipo": "auto_generato", "contenuto": "y" * 8000}
+            for j in range(n_docs)
+        ]).execute()
+
+    card_cols = "id, nome_riferimento, nome_cliente, tipo_causa, livello_aggressivita, created_at"
+    def _lista():
+        return client.table("fascicoli").select(card_cols).eq("user_id", user["id"]) \
+            .order("created_at", desc=True).order("id", desc=True).limit(26).execute().data
+    first = _lista()
+    c_ts, c_id = first[-1]["created_at"], first[-1]["id"]
+    casi = {
+        "lista_prima_pagina": _lista,
+        "lista_pagina_keyset": lambda: client.table("fascicoli").select(card_cols).eq("user_id", user["id"])
+            .or_(f'created_at.lt."{c_ts}",and(created_at.eq."{c_ts}",id.lt.{c_id})')
+            .order("created_at", desc=True).order("id", desc=True).limit(26).execute(),
+        "apri_fascicolo": lambda: client.table("fascicoli").select("*").eq("id", ids[len(ids) // 2]).execute(),
+        "lista_documenti": lambda: client.table("documenti_fascicolo")
+            .select("id, fascicolo_id, titolo, tipo, data_creazione, metadata_pricing, created_at")
+            .eq("fascicolo_id", ids[0]).order("created_at").execute(),
+        "aggiorna_campo": lambda: client.table("fascicoli").update({"livello_aggressivita": 7}).eq("id", ids[0]).execute(),
+    }
+    out = {}
+    for nome, fn in casi.items():
+        t0 = time.perf_counter()
+        for _ in range(ripetizioni): fn()
+        out[nome] = round(1000 * (time.perf_counter() - t0) / ripetizioni, 3)
+    return out
+
+if __name__ == "__main__":
+    import argparse
+    import tempfile
+    ap = argparse.ArgumentParser(description="Benchmark del backend SQLite locale")
+    ap.add_argument("--fascicoli", type=int, default=2000)
+    ap.add_argument("--path", default=None, help="file SQLite (default: temporaneo)")
+    args = ap.parse_args()
+    path = args.path or os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+    print(json.dumps(benchmark(LocalClient(path), args.fascicoli), indent=2))
@@ -0,0 +1,275 @@
+# modules/outbox.py
+"""
+Outbox email: i messaggi vengono accodati in modo durevole (SQLite) e spediti da un
+thread di sfondo su una sessione SMTP riusata (keep-alive), a lotti, con retry/backoff.
+La UI non apre più connessioni SMTP: accodare costa un INSERT locale.
+Per i test: `python -m modules.outbox --debug-server 1025` avvia un server SMTP di debug
+e config.OUTBOX_DEBUG_SMTP = "127.0.0.1:1025" ci manda tutta la posta.
+"""
+import os
+import smtplib
+import socketserver
+import sqlite3
+import threading
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+from . import config
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    destinatario TEXT NOT NULL,
+    oggetto TEXT NOT NULL,
+    corpo TEXT NOT NULL,
+    stato TEXT NOT NULL DEFAULT 'in_coda',      -- in_coda | inviata | fallita
+    tentativi INTEGER NOT NULL DEFAULT 0,
+    prossimo_tentativo REAL NOT NULL DEFAULT 0,
+    errore TEXT,
+    creata REAL NOT NULL,
+    inviata REAL
+)
+"""
+
+def smtp_settings(secrets):
+    """Parametri SMTP da st.secrets (o dal server di debug in config). None se non configurato."""
+    if config.OUTBOX_DEBUG_SMTP:
+        host, _, port = config.OUTBOX_DEBUG_SMTP.partition(":")
+        sender = secrets["smtp"]["email"] if "smtp" in secrets else "lexvantage@localhost"
+        return {"server": host, "port": int(port or 25), "email": sender, "debug": True}
+    if "smtp" not in secrets: return None
+    s = secrets["smtp"]
+    return {"server": s["server"], "port": int(s["port"]), "email": s["email"], "password": s["password"], "debug": False}
+
+class EmailOutbox:
+    """
+    Coda durevole + worker. enqueue() ritorna subito; il worker:
+    - prende fino a OUTBOX_BATCH_SIZE messaggi scaduti e li spedisce sulla stessa sessione SMTP,
+    - riusa la connessione finché risponde al NOOP e non resta inattiva oltre il keep-alive,
+    - in caso di errore riprova con backoff esponenziale fino a OUTBOX_MAX_ATTEMPTS.
+    """
+    def __init__(self, path, smtp_conf):
+        self.path = path
+        self.smtp_conf = smtp_conf
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._smtp = None
+        self._smtp_used = 0.0
+        self._lock = threading.Lock()
+        self._stats = {"connessioni": 0, "riusi": 0, "inviate": 0, "errori": 0}
+        if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db().execute(_SCHEMA)
+        self._thread = threading.Thread(target=self._run, name="email-outbox", daemon=True)
+        self._thread.start()
+
+    def _db(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    # --- API ---
+    def enqueue(self, to_email, subject, body):
+        now = time.time()
+        cur = self._db().execute(
+            "INSERT INTO outbox (destinatario, oggetto, corpo, creata, prossimo_tentativo) VALUES (?, ?, ?, ?, ?)",
+            (to_email, subject, body, now, now)
+        )
+        self._wake.set()
+        return cur.lastrowid
+
+    def drain(self, timeout=30):
+        """Attende che non restino messaggi da spedire subito (test, spegnimento)"""
+        end = time.time() + timeout
+        while time.time() < end:
+            if not self._due(1): return True
+            self._wake.set()
+            time.sleep(0.05)
+        return False
+
+    def stats(self):
+        rows = self._db().execute("SELECT stato, COUNT(*) FROM outbox GROUP BY stato").fetchall()
+        with self._lock:
+            out = dict(self._stats)
+        out.update({stato: n for stato, n in rows})
+        return out
+
+    def retry_failed(self):
+        cur = self._db().execute(
+            "UPDATE outbox SET stato = 'in_coda', tentativi = 0, prossimo_tentativo = ? WHERE stato = 'fallita'",
+            (time.time(),)
+        )
+        self._wake.set()
+        return cur.rowcount
+
+    # --- WORKER ---
+    def _due(self, limit):
+        return self._db().execute(
+            "SELECT id, destinatario, oggetto, corpo, tentativi FROM outbox "
+            "WHERE stato = 'in_coda' AND prossimo_tentativo <= ? ORDER BY id LIMIT ?",
+            (time.time(), limit)
+        ).fetchall()
+
+    def _connect(self):
+        c = self.smtp_conf
+        server = smtplib.SMTP(c["server"], c["port"], timeout=config.OUTBOX_SMTP_TIMEOUT)
+        if not c.get("debug"):
+            server.starttls()
+            server.login(c["email"], c["password"])
+        with self._lock: self._stats["connessioni"] += 1
+        return server
+
+    def _session(self):
+        """Connessione SMTP viva: riusata se risponde al NOOP, altrimenti riaperta"""
+        if self._smtp is not None:
+            try:
+                if self._smtp.noop()[0] == 250:
+                    with self._lock: self._stats["riusi"] += 1
+                    return self._smtp
+            except OSError: pass  # include SMTPException
+            self._close()
+        self._smtp = self._connect()
+        return self._smtp
+
+    def _close(self):
+        if self._smtp is None: return
+        try: self._smtp.quit()
+        except Exception: pass
+        self._smtp = None
+
+    def _message(self, row):
+        _, to_email, subject, body, _ = row
+        msg = MIMEMultipart()
+        msg['Subject'] = subject
+        msg['From'] = self.smtp_conf["email"]
+        msg['To'] = to_email
+        msg['Date'] = formatdate(localtime=True)
+        msg['Message-ID'] = make_msgid()
+        msg.attach(MIMEText(body, 'plain'))
+        return msg.as_string()
+
+    def _mark_sent(self, msg_id):
+        self._db().execute("UPDATE outbox SET stato = 'inviata', inviata = ?, errore = NULL WHERE id = ?", (time.time(), msg_id))
+        with self._lock: self._stats["inviate"] += 1
+
+    def _mark_retry(self, row, error, permanent=False):
+        msg_id, attempts = row[0], row[4] + 1
+        with self._lock: self._stats["errori"] += 1
+        if permanent or attempts >= config.OUTBOX_MAX_ATTEMPTS:
+            self._db().execute("UPDATE outbox SET stato = 'fallita', tentativi = ?, errore = ? WHERE id = ?", (attempts, str(error), msg_id))
+            return
+        delay = min(config.OUTBOX_BACKOFF_BASE * (2 ** (attempts - 1)), config.OUTBOX_BACKOFF_MAX)
+        self._db().execute(
+            "UPDATE outbox SET tentativi = ?, prossimo_tentativo = ?, errore = ? WHERE id = ?",
+            (attempts, time.time() + delay, str(error), msg_id)
+        )
+
+    def _send_batch(self, rows):
+        try:
+            smtp = self._session()
+        except Exception as e:
+            print(f"Errore connessione SMTP: {e}")
+            for row in rows: self._mark_retry(row, e)
+            return
+        for row in rows:
+            try:
+                smtp.sendmail(self.smtp_conf["email"], [row[1]], self._message(row))
+                self._mark_sent(row[0])
+            except smtplib.SMTPRecipientsRefused as e:
+                self._mark_retry(row, e, permanent=True)
+            except smtplib.SMTPServerDisconnected as e:
+                # Sessione persa: questo messaggio riprova, gli altri restano in coda per il giro dopo
+                self._smtp = None
+                self._mark_retry(row, e)
+                return
+            except smtplib.SMTPException as e:
+                self._mark_retry(row, e)
+            except OSError as e:
+                self._close()
+                self._mark_retry(row, e)
+                return
+        self._smtp_used = time.time()
+
+    def _run(self):
+        while True:
+            self._wake.wait(config.OUTBOX_POLL_SECONDS)
+            self._wake.clear()
+            try:
+                while True:
+                    rows = self._due(config.OUTBOX_BATCH_SIZE)
+                    if not rows: break
+                    self._send_batch(rows)
+                    if len(rows) < config.OUTBOX_BATCH_SIZE: break
+                if self._smtp is not None and time.time() - self._smtp_used > config.OUTBOX_KEEPALIVE_SECONDS:
+                    self._close()
+            except Exception as e:
+                print(f"Errore outbox email: {e}")
+
+# --- SERVER SMTP DI DEBUG (solo test/sviluppo) ---
+class _DebugSMTPHandler(socketserver.StreamRequestHandler):
+    """SMTP minimale: accetta tutto e conserva i messaggi in server.messages"""
+    def _reply(self, line):
+        self.wfile.write((line + "\r\n").encode("utf-8"))
+
+    def handle(self):
+        self.server.n_connessioni += 1
+        self._reply("220 lexvantage-debug ESMTP")
+        mail_from, rcpt = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line: return
+            cmd = line.decode("utf-8", "replace").strip()
+            verb = cmd[:4].upper()
+            if verb in ("EHLO", "HELO"):
+                self._reply("250 lexvantage-debug")
+            elif verb == "MAIL":
+                mail_from, rcpt = cmd.partition(":")[2].strip(" <>"), []
+                self._reply("250 OK")
+            elif verb == "RCPT":
+                rcpt.append(cmd.partition(":")[2].strip(" <>"))
+                self._reply("250 OK")
+            elif verb == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                for raw in self.rfile:
+                    if raw in (b".\r\n", b".\n"): break
+                    data.append(raw[1:] if raw.startswith(b"..") else raw)
+                self.server.messages.append({"from": mail_from, "to": rcpt, "data": b"".join(data).decode("utf-8", "replace")})
+                self._reply("250 OK queued")
+            elif verb in ("NOOP", "RSET"):
+                self._reply("250 OK")
+            elif verb == "QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("502 Command not implemented")
+
+class DebugSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=1025):
+        super().__init__((host, port), _DebugSMTPHandler)
+        self.messages = []
+        self.n_connessioni = 0
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="debug-smtp", daemon=True).start()
+        return self
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="Server SMTP di debug (stampa i messaggi ricevuti)")
+    ap.add_argument("--debug-server", type=int, default=1025, metavar="PORTA")
+    args = ap.parse_args()
+    srv = DebugSMTPServer(port=args.debug_server).start()
+    print(f"SMTP di debug su 127.0.0.1:{args.debug_server}")
+    seen = 0
+    while True:
+        time.sleep(0.5)
+        for m in srv.messages[seen:]:
+            print(f"--- da {m['from']} a {', '.join(m['to'])}\n{m['data']}")
+        seen = len(srv.messages)
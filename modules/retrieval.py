@@ -0,0 +1,108 @@
+# modules/retrieval.py
+import re
+import math
+from collections import Counter, defaultdict
+from . import config
+
+# Stopword italiane più frequenti (il resto lo pesa l'IDF)
+STOPWORDS = set("""
+il lo la i gli le un uno una di del dello della dei degli delle a al allo alla ai agli alle
+da dal dallo dalla dai dagli dalle in nel nello nella nei negli nelle su sul sullo sulla sui
+sugli sulle con per tra fra e ed o od ma che chi cui non si se come anche più questo questa
+questi queste quello quella quelli quelle è sono essere stato stata ha hanno ho avere
+""".split())
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+def tokenize(text):
+    return [t for t in TOKEN_RE.findall((text or "").lower()) if len(t) > 2 and t not in STOPWORDS]
+
+def chunk_text(text, source, chunk_chars=None, overlap=None):
+    """Spezza un documento in chunk sovrapposti, tagliando preferibilmente a fine paragrafo"""
+    chunk_chars = chunk_chars or config.RAG_CHUNK_CHARS
+    overlap = config.RAG_CHUNK_OVERLAP if overlap is None else overlap
+    chunks = []
+    start, n = 0, len(text)
+    while start < n:
+        end = min(n, start + chunk_chars)
+        if end < n:
+            cut = text.rfind("\n", start + chunk_chars // 2, end)
+            if cut != -1: end = cut
+        piece = text[start:end]
+        lead = len(piece) - len(piece.lstrip())
+        piece = piece.strip()
+        if piece: chunks.append({"source": source, "text": piece, "start": start + lead, "end": start + lead + len(piece)})
+        if end >= n: break
+        start = max(end - overlap, start + 1)
+        sp = text.find(" ", start, end)  # niente parole tagliate a inizio chunk
+        if sp != -1: start = sp + 1
+    return chunks
+
+def chunk_store(store):
+    """
+    Chunk di un doc_renderer.ExtractedTextStore senza copiarne il testo:
+    ogni chunk conserva solo (record, inizio, fine) e il testo si rilegge su richiesta.
+    """
+    chunks = []
+    for idx, source, page, text in store.iter_records():
+        for ch in chunk_text(text, source):
+            chunks.append({"source": source, "page": page, "rec": idx, "start": ch["start"], "end": ch["end"]})
+    return chunks
+
+class BM25Index:
+    """
+    Indice lessicale BM25 (Okapi) sui chunk di un fascicolo.
+    Costruito una volta al caricamento dei file; ogni query costa solo
+    la scansione delle posting list dei termini cercati.
+    Se i chunk non contengono 'text', lo recupera loader(chunk) (es. dallo store su disco).
+    """
+    def __init__(self, chunks, k1=1.5, b=0.75, loader=None):
+        self.chunks = chunks
+        self.loader = loader
+        self.k1, self.b = k1, b
+        self.postings = defaultdict(list)  # termine -> [(id_chunk, tf)]
+        self.lengths = []
+        for i, ch in enumerate(chunks):
+            tf = Counter(tokenize(self.text_of(ch)))
+            self.lengths.append(sum(tf.values()))
+            for term, freq in tf.items():
+                self.postings[term].append((i, freq))
+        self.avg_len = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+        n = len(chunks)
+        self.idf = {t: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for t, p in self.postings.items()}
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def text_of(self, ch):
+        return ch["text"] if "text" in ch else self.loader(ch)
+
+    def search(self, query, k=None):
+        """Restituisce [(score, chunk)] ordinati per rilevanza"""
+        k = k or config.RAG_TOP_K
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None: continue
+            for i, tf in self.postings[term]:
+                norm = 1 - self.b + self.b * (self.lengths[i] / self.avg_len if self.avg_len else 1)
+                scores[i] += idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+        best = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:k]
+        return [(sc, self.chunks[i]) for i, sc in best]
+
+    def select(self, query, token_budget, k=None):
+        """Estratti top-k entro il budget di token (~4 caratteri/token), come lista di stringhe"""
+        out, used = [], 0
+        for _, ch in self.search(query, k):
+            block = f"[{ch['source']}]\n{self.text_of(ch)}"
+            cost = len(block) // 4
+            if used + cost > token_budget: continue
+            out.append(block)
+            used += cost
+        return out
+
+def build_index_from_store(store):
+    """Indice del fascicolo a partire da un ExtractedTextStore (testo letto on demand)"""
+    chunks = chunk_store(store)
+    if not chunks: return None
+    return BM25Index(chunks, loader=lambda ch: store.read_record(ch["rec"])[ch["start"]:ch["end"]])
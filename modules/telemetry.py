@@ -0,0 +1,279 @@
+# modules/telemetry.py
+"""
+Strumentazione degli accessi ai dati per rerun Streamlit.
+Registra numero di chiamate, latenza, byte e token per (tipo, nome):
+- "db": ogni execute() sul client database (round-trip reale, vedi strumenta_client)
+- "ai": ogni chiamata Gemini (o hit di cache), "render": fasi di doc_renderer.
+Esposto come pannello di debug in sidebar, log JSON per rerun e testo OpenMetrics.
+"""
+import contextvars
+import functools
+import json
+import logging
+import os
+from logging.handlers import RotatingFileHandler
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import streamlit as st
+from . import config
+
+_current = contextvars.ContextVar("telemetria_rerun", default=None)
+_log_lock = threading.Lock()
+_log_handler = None
+
+class CallStats:
+    """Aggregati per (tipo, nome): [chiamate, secondi, byte, token, errori]. Thread-safe."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def add(self, kind, name, seconds, nbytes=0, tokens=0, error=False):
+        with self._lock:
+            row = self._data.setdefault((kind, name), [0, 0.0, 0, 0, 0])
+            row[0] += 1
+            row[1] += seconds
+            row[2] += int(nbytes or 0)
+            row[3] += int(tokens or 0)
+            row[4] += 1 if error else 0
+
+    def merge(self, other):
+        for (kind, name), row in other.snapshot().items():
+            with self._lock:
+                mine = self._data.setdefault((kind, name), [0, 0.0, 0, 0, 0])
+                for i, v in enumerate(row): mine[i] += v
+
+    def snapshot(self):
+        with self._lock:
+            return {k: list(v) for k, v in self._data.items()}
+
+    def rows(self):
+        """Righe per tabella/log, ordinate per tempo totale"""
+        out = [{
+            "tipo": kind, "nome": name, "chiamate": r[0], "ms_totali": round(r[1] * 1000, 1),
+            "ms_medi": round(r[1] * 1000 / r[0], 1) if r[0] else 0.0,
+            "byte": r[2], "token": r[3], "errori": r[4]
+        } for (kind, name), r in self.snapshot().items()]
+        return sorted(out, key=lambda x: x["ms_totali"], reverse=True)
+
+    def totals(self):
+        """{tipo: {chiamate, ms, byte, token}}"""
+        out = {}
+        for (kind, _), r in self.snapshot().items():
+            t = out.setdefault(kind, {"chiamate": 0, "ms": 0.0, "byte": 0, "token": 0})
+            t["chiamate"] += r[0]
+            t["ms"] = round(t["ms"] + r[1] * 1000, 1)
+            t["byte"] += r[2]
+            t["token"] += r[3]
+        return out
+
+class RerunStats(CallStats):
+    def __init__(self, numero):
+        super().__init__()
+        self.numero = numero
+        self.inizio = time.time()
+
+_PROCESSO = CallStats()
+
+# --- REGISTRAZIONE ---
+def record(kind, name, seconds, nbytes=0, tokens=0, error=False):
+    """Registra una chiamata nel rerun corrente (se c'è) e nei totali di processo"""
+    rec = _current.get()
+    if rec is not None: rec.add(kind, name, seconds, nbytes, tokens, error)
+    _PROCESSO.add(kind, name, seconds, nbytes, tokens, error)
+
+def traccia(kind, name=None, bytes_of=None, tokens_of=None):
+    """Decoratore: tempo della funzione; bytes_of/tokens_of(risultato) per byte e token"""
+    def deco(fn):
+        label = name or fn.__name__
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            out, error = None, False
+            try:
+                out = fn(*args, **kwargs)
+                return out
+            except Exception:
+                error = True
+                raise
+            finally:
+                nbytes = tokens = 0
+                if not error:
+                    try:
+                        if bytes_of: nbytes = bytes_of(out)
+                        if tokens_of: tokens = tokens_of(out)
+                    except Exception: pass
+                record(kind, label, time.perf_counter() - t0, nbytes, tokens, error)
+        return wrapper
+    return deco
+
+def propaga(fn):
+    """Esegue fn in un altro thread mantenendo il rerun corrente (per i pool di thread)"""
+    ctx = contextvars.copy_context()
+    return functools.partial(ctx.run, fn)
+
+def _payload_bytes(data):
+    if data is None: return 0
+    try: return len(json.dumps(data, default=str))
+    except (TypeError, ValueError): return 0
+
+# --- CLIENT DATABASE STRUMENTATO ---
+class _QueryProxy:
+    """Inoltra la catena del query builder; misura solo execute() (= un round-trip)"""
+    def __init__(self, builder, label, op="select"):
+        self._builder = builder
+        self._label = label
+        self._op = op
+
+    def __getattr__(self, attr):
+        target = getattr(self._builder, attr)
+        if not callable(target): return target
+        op = attr if attr in ("select", "insert", "update", "upsert", "delete") else self._op
+        def call(*args, **kwargs):
+            res = target(*args, **kwargs)
+            return _QueryProxy(res, self._label, op) if hasattr(res, "execute") else res
+        return call
+
+    def execute(self):
+        t0 = time.perf_counter()
+        res, error = None, False
+        try:
+            res = self._builder.execute()
+            return res
+        except Exception:
+            error = True
+            raise
+        finally:
+            label = self._label if self._label.startswith("rpc:") else f"{self._label}.{self._op}"
+            record("db", label, time.perf_counter() - t0,
+                   _payload_bytes(getattr(res, "data", None)), error=error)
+
+class InstrumentedClient:
+    """Involucro del client database (Supabase o locale): stessa interfaccia, execute() misurati"""
+    def __init__(self, client):
+        self._client = client
+
+    def table(self, name):
+        return _QueryProxy(self._client.table(name), name)
+
+    def rpc(self, name, params=None):
+        return _QueryProxy(self._client.rpc(name, params), f"rpc:{name}", "rpc")
+
+    def __getattr__(self, attr):
+        return getattr(self._client, attr)
+
+def strumenta_client(client):
+    if client is None or not config.TELEMETRY_ENABLED: return client
+    return InstrumentedClient(client)
+
+# --- CICLO DEL RERUN ---
+def _get_log_handler():
+    """File di log ruotato per dimensione (TELEMETRY_LOG_MAX_MB x TELEMETRY_LOG_BACKUPS), aperto una volta"""
+    global _log_handler
+    if _log_handler is None:
+        os.makedirs(os.path.dirname(config.TELEMETRY_LOG) or ".", exist_ok=True)
+        _log_handler = RotatingFileHandler(
+            config.TELEMETRY_LOG, maxBytes=int(config.TELEMETRY_LOG_MAX_MB * 1024 * 1024),
+            backupCount=config.TELEMETRY_LOG_BACKUPS, encoding="utf-8"
+        )
+        _log_handler.setFormatter(logging.Formatter("%(message)s"))
+    return _log_handler
+
+def _scrivi_log(session_id, rec):
+    if not config.TELEMETRY_LOG: return
+    entry = {
+        "ts": datetime.fromtimestamp(rec.inizio).isoformat(timespec="seconds"),
+        "sessione": session_id,
+        "rerun": rec.numero,
+        "totali": rec.totals(),
+        "chiamate": rec.rows()
+    }
+    try:
+        with _log_lock:
+            handler = _get_log_handler()
+        handler.handle(logging.makeLogRecord({"msg": json.dumps(entry, default=str)}))
+    except OSError as e:
+        print(f"Errore log telemetria: {e}")
+
+def begin_rerun(session_state):
+    """
+    Da chiamare in cima allo script. Chiude il rerun precedente (st.stop/st.rerun non
+    lasciano un punto di uscita): lo scrive nel log e lo somma ai totali di sessione.
+    """
+    if not config.TELEMETRY_ENABLED: return None
+    if "_telemetria_sessione" not in session_state:
+        session_state["_telemetria_sessione"] = CallStats()
+        session_state["_telemetria_id"] = f"{int(time.time())}-{id(session_state) % 100000}"
+    prev = session_state.get("_telemetria_rerun")
+    if prev is not None:
+        session_state["_telemetria_sessione"].merge(prev)
+        session_state["_telemetria_ultimo"] = prev
+        if prev.snapshot(): _scrivi_log(session_state["_telemetria_id"], prev)
+    rec = RerunStats(prev.numero + 1 if prev else 1)
+    session_state["_telemetria_rerun"] = rec
+    _current.set(rec)
+    return rec
+
+# --- ESPOSIZIONE ---
+def _om_escape(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def openmetrics():
+    """Totali di processo in formato testo OpenMetrics"""
+    snap = _PROCESSO.snapshot()
+    families = [
+        ("lexvantage_calls", "Chiamate per tipo e nome", 0),
+        ("lexvantage_call_seconds", "Tempo totale delle chiamate", 1),
+        ("lexvantage_call_bytes", "Byte di payload", 2),
+        ("lexvantage_call_tokens", "Token Gemini", 3),
+        ("lexvantage_call_errors", "Chiamate fallite", 4),
+    ]
+    lines = []
+    for fam, help_txt, idx in families:
+        lines.append(f"# TYPE {fam} counter")
+        lines.append(f"# HELP {fam} {help_txt}")
+        for (kind, name), row in sorted(snap.items()):
+            lines.append(f'{fam}_total{{kind="{_om_escape(kind)}",name="{_om_escape(name)}"}} {row[idx]}')
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_response(404); self.end_headers(); return
+        body = openmetrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@st.cache_resource
+def avvia_endpoint_metriche():
+    """Endpoint HTTP /metrics (OpenMetrics) su config.TELEMETRY_METRICS_PORT, uno per processo"""
+    if not config.TELEMETRY_METRICS_PORT: return None
+    try:
+        server = ThreadingHTTPServer(("127.0.0.1", int(config.TELEMETRY_METRICS_PORT)), _MetricsHandler)
+    except OSError as e:
+        print(f"Errore endpoint metriche: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name="telemetria-metrics", daemon=True).start()
+    return server
+
+def render_panel(session_state):
+    """Pannello di debug (sidebar): ultimo rerun completato e totali della sessione"""
+    with st.expander("🔍 Diagnostica Accessi Dati"):
+        ultimo = session_state.get("_telemetria_ultimo")
+        if ultimo is None:
+            st.caption("Nessun rerun completato.")
+            return
+        st.caption(f"Rerun #{ultimo.numero}")
+        st.json(ultimo.totals())
+        rows = ultimo.rows()
+        if rows: st.dataframe(rows, use_container_width=True, hide_index=True)
+        st.caption("Sessione")
+        st.json(session_state["_telemetria_sessione"].totals())
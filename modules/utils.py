@@ -1,31 +1,31 @@
 # modules/utils.py
-import smtplib
 import streamlit as st
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from . import config, outbox
 
 # --- EMAIL SYSTEM ---
+@st.cache_resource
+def get_outbox():
+    """Outbox email condivisa dal processo (None se SMTP non configurato)"""
+    conf = outbox.smtp_settings(st.secrets)
+    if not conf: return None
+    return outbox.EmailOutbox(config.OUTBOX_DB_PATH, conf)
+
 def send_email(to_email, subject, body):
-    """Funzione generica invio mail SMTP"""
-    if "smtp" not in st.secrets: return False, "No SMTP config"
+    """
+    Funzione generica invio mail: accoda nell'outbox e ritorna subito.
+    L'invio SMTP avviene in background (sessione riusata, retry con backoff).
+    """
     try:
-        msg = MIMEMultipart()
-        msg['Subject'] = subject
-        msg['From'] = st.secrets["smtp"]["email"]
-        msg['To'] = to_email
-        msg.attach(MIMEText(body, 'plain'))
-
-        server = smtplib.SMTP(st.secrets["smtp"]["server"], st.secrets["smtp"]["port"])
-        server.starttls()
-        server.login(st.secrets["smtp"]["email"], st.secrets["smtp"]["password"])
-        server.sendmail(st.secrets["smtp"]["email"], to_email, msg.as_string())
-        server.quit()
+        box = get_outbox()
+        if box is None: return False, "No SMTP config"
+        box.enqueue(to_email, subject, body)
         return True, "OK"
     except Exception as e:
         return False, str(e)
 
 def send_admin_alert(new_user_email):
     """Avvisa admin di nuova registrazione"""
+    if "smtp" not in st.secrets: return False, "No SMTP config"
     admin_mail = st.secrets["smtp"]["email"]
     body = f"Utente {new_user_email} richiede accesso. Vai al pannello Admin."
     return send_email(admin_mail, "🔔 Nuovo Iscritto LexVantage", body)